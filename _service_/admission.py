@@ -0,0 +1,147 @@
+"""
+Admission control for serve.py
+
+Handlers of serve.py do not wait on anything, so "in flight" are mostly the
+requests which were received (headers parsed) but are still waiting for
+their turn in the event loop, i.e. it is the depth of the queue of the
+worker.  Whenever it is over the cap, new requests are rejected right away
+with 429 so the queue (and thus latency) stays bounded.
+
+Optionally every client (as identified by X-Forwarded-For set by the
+reverse proxy, or the peer address) gets a token bucket, so a single client
+flooding the service gets 429s while others are still served.  Since a 429
+costs about as much as a regular response, a client ignoring Retry-After
+would still hog the worker, so serve.py could hold its 429s for a while
+(without being in flight) to slow it down.
+
+Counters are per worker process.
+"""
+
+import math
+import time
+from collections import Counter
+
+from sanic.request import Request
+
+# how often (in number of new clients) to forget idle clients
+PRUNE_EVERY = 10000
+
+
+class TokenBuckets:
+    """Token bucket per client: `rate` requests per second, up to `burst` at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.buckets = {}  # client: [tokens, time of last update]
+        self._new = 0
+
+    def take(self, client, now):
+        """Take a token for the client. Return 0, or seconds to wait for one"""
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            self._new += 1
+            if self._new >= PRUNE_EVERY:
+                self.prune(now)
+            bucket = self.buckets[client] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0
+        return (1 - bucket[0]) / self.rate
+
+    def prune(self, now):
+        """Forget clients whose buckets would be full by now anyways"""
+        full = self.burst / self.rate
+        self.buckets = {
+            k: v for k, v in self.buckets.items() if now - v[1] < full}
+        self._new = 0
+
+
+class Admission:
+
+    def __init__(self, max_in_flight=0, rate=0, burst=0):
+        """
+        Parameters
+        ----------
+        max_in_flight: int
+          Cap on the number of requests received but not yet responded to.
+          0 to disable.
+        rate: float
+          Requests per second allowed per client.  0 to disable.
+        burst: int
+          Size of the per client bucket (defaults to rate).
+        """
+        self.max_in_flight = max_in_flight
+        self.buckets = TokenBuckets(rate, burst or math.ceil(rate)) if rate else None
+        self.in_flight = 0
+        self.max_seen = 0
+        self.counts = Counter()
+
+    def start(self):
+        self.in_flight += 1
+        if self.in_flight > self.max_seen:
+            self.max_seen = self.in_flight
+
+    def finish(self):
+        self.in_flight -= 1
+
+    def admit(self, client):
+        """Return None if the request is admitted, or (reason, seconds to retry after)"""
+        if self.max_in_flight and self.in_flight > self.max_in_flight:
+            self.counts['rejected_in_flight'] += 1
+            return 'in_flight', 1
+        if self.buckets is not None:
+            wait = self.buckets.take(client, time.monotonic())
+            if wait:
+                self.counts['rejected_rate'] += 1
+                return 'rate', wait
+        self.counts['admitted'] += 1
+        return None
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'max_in_flight_seen': self.max_seen,
+            'max_in_flight': self.max_in_flight,
+            'clients': len(self.buckets.buckets) if self.buckets is not None else None,
+            'admitted': self.counts['admitted'],
+            'rejected_in_flight': self.counts['rejected_in_flight'],
+            'rejected_rate': self.counts['rejected_rate'],
+        }
+
+
+# the one for this process, see setup()
+controller = Admission()
+
+
+def setup(*args, **kwargs):
+    """Configure admission control of this process (before serving)"""
+    global controller
+    controller = Admission(*args, **kwargs)
+    return controller
+
+
+class AdmissionRequest(Request):
+    """Request which is accounted as in flight since its headers got parsed
+
+    It is done with once the response passed the middleware, or once
+    the request is gone without a response (e.g. client disconnected).
+    """
+    __slots__ = ('_in_flight', 'received')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = time.perf_counter()
+        self._in_flight = True
+        controller.start()
+
+    def done(self):
+        if getattr(self, '_in_flight', False):
+            self._in_flight = False
+            controller.finish()
+
+    def __del__(self):
+        self.done()
@@ -0,0 +1,134 @@
+"""
+Serving images straight from a local clone of the dataset
+
+Images in the tree are git-annex symlinks into .git/annex/objects/, and the
+object is there only if it was fetched (datalad get).  The ETag is the
+annex key (MD5E-s<size>--<md5>) of the object, so it is the same for the
+same image regardless of its path.
+
+Files are sent with zero-copy os.sendfile.  uvloop (used by sanic) neither
+implements loop.sendfile nor allows to watch the socket of a transport, so
+it is done in a thread, waiting for the socket to become writable with
+poll().  Number of such threads is limited, so a number of slow clients
+could not take it all.
+"""
+
+import asyncio
+import os
+import os.path as op
+import re
+import select
+from collections import namedtuple
+
+# extensions of images we serve
+IMAGE_EXTENSIONS = ('.sif', '.simg')
+ANNEX_KEY_REGEX = re.compile(r'^(?P<backend>MD5E?)-s(?P<size>\d+)--(?P<md5>[0-9a-f]{32})')
+# give up on a client which does not read anything for that long
+SEND_TIMEOUT = 60
+# maximal chunk per sendfile call
+SEND_CHUNK = 1 << 24
+
+LocalFile = namedtuple('LocalFile', 'path size etag')
+
+
+def check_path(path):
+    """Raise ValueError unless path could be of an image in the tree"""
+    parts = path.split('/')
+    if (not path.endswith(IMAGE_EXTENSIONS)
+            or any(p in ('', '.', '..') for p in parts)
+            or parts[0] == '.git'):
+        raise ValueError(f"Not an image path: {path}")
+
+
+class LocalTree:
+    """Local clone of the dataset to serve images from"""
+
+    def __init__(self, root):
+        self.root = op.realpath(root)
+
+    def get(self, path):
+        """Return LocalFile for the path (passed check_path) within the tree
+
+        Returns None if not present.
+        """
+        link = op.join(self.root, *path.split('/'))
+        realpath = op.realpath(link)
+        if not realpath.startswith(self.root + os.sep):
+            return None
+        try:
+            st = os.stat(realpath)
+        except OSError:
+            # broken symlink -- annex object is not present
+            return None
+        res = ANNEX_KEY_REGEX.match(op.basename(realpath))
+        if res and int(res.group('size')) == st.st_size:
+            etag = f'"{res.group(0)}"'
+        else:
+            # not annexed (or unlocked): not as good but still would change
+            # if file changes
+            etag = f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
+        return LocalFile(realpath, st.st_size, etag)
+
+
+def parse_range(value, size):
+    """Parse Range header value into (start, end) inclusive
+
+    Returns None if range should be ignored (not bytes or multiple ranges,
+    which we do not bother to support), and raises ValueError if it is
+    not satisfiable.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    start, sep, end = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if not start:
+            # the last N bytes
+            n = int(end)
+            if n <= 0:
+                raise ValueError(value)
+            return max(0, size - n), size - 1
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        raise ValueError(value)
+    if start >= size or start > end:
+        raise ValueError(value)
+    return start, end
+
+
+def _sendfile(sock_fd, fd, offset, count):
+    """Send count bytes of the file from offset into non-blocking socket"""
+    poller = select.poll()
+    poller.register(sock_fd, select.POLLOUT)
+    while count > 0:
+        try:
+            sent = os.sendfile(sock_fd, fd, offset, min(count, SEND_CHUNK))
+        except BlockingIOError:
+            sent = None
+        if sent == 0:
+            raise EOFError("file got truncated")
+        if sent:
+            offset += sent
+            count -= sent
+        elif not poller.poll(SEND_TIMEOUT * 1000):
+            raise TimeoutError("client does not read")
+
+
+async def sendfile(response, fd, offset, count, executor):
+    """Send (a part of) the body of streaming response from the open file
+
+    Sending does not change the position in the file, so the same fd could
+    be used by many at once.
+    """
+    transport = response.protocol.transport
+    if transport.get_write_buffer_size():
+        # headers (or whatever was before) must be out before we bypass transport
+        transport.set_write_buffer_limits(high=0)
+        await response.protocol.drain()
+        transport.set_write_buffer_limits()
+    sock_fd = transport.get_extra_info('socket').fileno()
+    await asyncio.get_event_loop().run_in_executor(
+        executor, _sendfile, sock_fd, fd, offset, count)
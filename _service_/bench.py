@@ -0,0 +1,748 @@
+"""
+Load testing of serve.py
+
+Starts serve.py (in DEV mode, unless --production-logging) against either a
+given images.json or a synthetic catalog of the desired size, hammers it with
+requests for all known name:tag's over keep-alive connections from a few
+client processes, and reports throughput, latency percentiles and RSS of the
+service, e.g.
+
+    python _service_/bench.py run --synthetic 6000 --output after.json
+    python _service_/bench.py run --serve /tmp/old/serve.py --output before.json
+
+`scaling` does the same for a range of --workers to see how throughput
+scales and how much memory each worker really adds (PSS/private as
+reported by /proc/PID/smaps_rollup).
+
+`flood` shows how admission control (--max-in-flight, --rate-limit) keeps
+latency of well-behaved clients bounded while another client floods.
+
+`mix` load tests with a realistic mix of requests: popular containers much
+more often than others, bare names (latest) vs explicit tags vs tag@version,
+scans for missing ones (404s) and collections/ redirects.  Shares of those
+(and popularity of containers) are taken from the logs.apirequestcount.json
+of the database dump if available, e.g.
+
+    python _service_/bench.py mix --catalog _data_/images.json --output mix.json
+
+`build` micro-benchmarks building the catalog serve.py main() does (and
+compiling the index), without the service.
+
+`search` times the search index (search.py) alone, without the service.
+
+`profiling` checks what slow request tracing (--slow-request) and a
+running profiler (SIGUSR1) cost, compared to the service with both off.
+"""
+
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import os.path as op
+import random
+import re
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import click
+
+SERVE = op.join(op.dirname(op.abspath(__file__)), "serve.py")
+PROCESS_DUMP = op.join(op.dirname(op.dirname(op.abspath(__file__))),
+                       "_tools_", "process_dump.py")
+REQUEST_COUNTS = op.join(op.dirname(op.dirname(op.abspath(__file__))),
+                         "_data_", "dump", "backup-2021", "logs.apirequestcount.json")
+# shares of kinds of requests, unless known from REQUEST_COUNTS
+DEFAULT_MIX = {
+    "latest": 0.5,       # container/org/repo
+    "tag": 0.3,          # container/org/repo:tag
+    "tag_version": 0.05,  # container/org/repo:tag@version
+    "missing": 0.1,      # container/ which are not there
+    "collection": 0.05,  # collections/pk
+}
+API_PATH_REGEX = re.compile(
+    r'/(?:api/)?(?:(?P<collection>collections?/\d+)'
+    r'|container/(?P<name>[^/]+/[^/:@]+)(?P<tag>:[^@]*)?(?P<version>@.*)?)/?$')
+
+
+def synthetic_catalog(n, seed=0):
+    """Generate images.json-like structure with n images"""
+    rnd = random.Random(seed)
+    images = {}
+    collections = {}
+    for i in range(n):
+        name = f"org{i % 97}/repo{i}"
+        recs = []
+        for j in range(rnd.randint(1, 4)):
+            md5 = "%032x" % rnd.getrandbits(128)
+            commit = "%040x" % rnd.getrandbits(160)
+            tag = rnd.choice(["latest", "v1.0", "v2.0", "dev", f"t{j}"])
+            build_date = f"2019-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}" \
+                         f"T{rnd.randint(0, 23):02d}:{j:02d}:00.000Z"
+            recs.append({
+                "id": i * 10 + j,
+                "branch": "master",
+                "tag": tag,
+                "commit": commit,
+                "version": md5,
+                "build_date": build_date,
+                "size_mb": 100 + j,
+                "file": f"{name}/{tag}/{build_date[:10]}-{commit[:8]}-{md5[:8]}/{md5}.sif",
+                "collection": i,
+                "size": 1000000 + j,
+                "md5": md5,
+                "file_orig": f"{name}/{commit}/{md5}/{md5}.sif",
+            })
+        images[name] = recs
+        collections[str(i)] = {
+            "license": rnd.choice([None, "MIT", "GPL-3.0"]),
+            "full_name": name,
+        }
+    return {"images": images, "collections": collections}
+
+
+def get_paths(catalog):
+    """All paths to request: every name:tag/version, bare names, and collections"""
+    paths = []
+    for name, recs in catalog["images"].items():
+        paths.append(f"/container/{name}")
+        for r in recs:
+            paths.append(f"/container/{name}:{r['tag']}")
+            paths.append(f"/container/{name}:{r['version']}")
+    paths.extend(f"/collections/{pk}" for pk in catalog["collections"])
+    return paths
+
+
+def load_request_counts(path):
+    """Return (Counter of kinds of requests, Counter of names) from the dump
+
+    Records are expected to have path (or endpoint/url) and count among
+    their fields.  Paths of anything but containers and collections are
+    ignored.
+    """
+    with open(path) as f:
+        recs = json.load(f)
+    kinds, names = Counter(), Counter()
+    for rec in recs:
+        fields = rec.get("fields", rec)
+        path = next((fields[k] for k in ("path", "endpoint", "url", "request_path")
+                     if isinstance(fields.get(k), str)), None)
+        res = API_PATH_REGEX.search(path or "")
+        if not res:
+            continue
+        count = int(next((fields[k] for k in ("count", "hits", "requests")
+                          if fields.get(k) is not None), 1))
+        if res.group("collection"):
+            kinds["collection"] += count
+            continue
+        if res.group("version"):
+            kinds["tag_version"] += count
+        elif res.group("tag") and res.group("tag") != ":":
+            kinds["tag"] += count
+        else:
+            kinds["latest"] += count
+        names[res.group("name")] += count
+    return kinds, names
+
+
+def request_mix(catalog, size, counts_path=None, seed=0):
+    """Return (list of size paths to request, shares of kinds used)
+
+    Popularity of containers follows counts_path if given, and otherwise
+    (and for those never requested) Zipf distribution.  Requests for
+    missing ones (bots scanning, typos) are to existing names with missing
+    tags and to names which are not there at all.
+    """
+    rnd = random.Random(seed)
+    names = sorted(catalog["images"])
+    rnd.shuffle(names)
+    weights = [1 / (rank + 1) ** 1.1 for rank in range(len(names))]
+    mix = dict(DEFAULT_MIX)
+    if counts_path:
+        kinds, counted = load_request_counts(counts_path)
+        if kinds:
+            total = sum(kinds.values())
+            # log would not tell us about 404s, so keep the default share of those
+            mix = {k: kinds[k] / total * (1 - DEFAULT_MIX["missing"])
+                   for k in DEFAULT_MIX if k != "missing"}
+            mix["missing"] = DEFAULT_MIX["missing"]
+        if counted:
+            scale = sum(counted.values()) / sum(weights)
+            # those never requested get a tail as if they were the least popular
+            weights = [counted.get(n) or w * scale * 0.01 for n, w in zip(names, weights)]
+    name_collection = {c["full_name"]: pk for pk, c in catalog["collections"].items()}
+    chosen = rnd.choices(names, weights, k=size)
+    kinds = rnd.choices(list(mix), list(mix.values()), k=size)
+    paths = []
+    for i, (name, kind) in enumerate(zip(chosen, kinds)):
+        recs = catalog["images"][name]
+        rec = rnd.choice(recs)
+        if kind == "latest":
+            paths.append(f"/container/{name}")
+        elif kind == "tag":
+            paths.append(f"/container/{name}:{rec['tag']}")
+        elif kind == "tag_version":
+            paths.append(f"/container/{name}:{rec['tag']}@{rec['version']}")
+        elif kind == "collection" and name in name_collection:
+            paths.append(f"/collections/{name_collection[name]}")
+        elif i % 2:
+            paths.append(f"/container/{name}:missing{i % 7}")
+        else:
+            paths.append(f"/container/scan{i % 1000}/repo{i % 13}")
+    return paths, {k: round(v, 4) for k, v in mix.items()}
+
+
+def _get_process_memory(pid):
+    """rss, pss and private memory (in kB) of a process"""
+    fields = {"Rss": "rss", "Pss": "pss",
+              "Private_Clean": "private", "Private_Dirty": "private"}
+    mem = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                k, v = line.split(":", 1)
+                if k in fields:
+                    mem[fields[k]] = mem.get(fields[k], 0) + int(v.split()[0])
+    except OSError:
+        # older kernel? at least get RSS
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    mem["rss"] = int(line.split()[1])
+    return mem
+
+
+def get_memory(pid):
+    """Memory of the process and all its descendants, per process"""
+    children = {}
+    for p in os.listdir("/proc"):
+        if not p.isdigit():
+            continue
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(p))
+    mem = {}
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        try:
+            mem[p] = _get_process_memory(p)
+        except OSError:
+            continue
+        todo.extend(children.get(p, []))
+    return mem
+
+
+async def _request(reader, writer, path, extra_headers=""):
+    writer.write(
+        f"GET {path} HTTP/1.1\r\nHost: localhost\r\n{extra_headers}\r\n".encode())
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        k, v = line.decode().split(":", 1)
+        headers[k.lower()] = v.strip()
+    length = int(headers.get("content-length", 0))
+    if length:
+        await reader.readexactly(length)
+    return status, headers
+
+
+async def _client(port, paths, duration, concurrency, revalidate, seed,
+                  extra_headers="", interval=0):
+    rnd = random.Random(seed)
+    latencies = []
+    statuses = {}
+
+    async def connection():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        etags = {}
+        deadline = time.perf_counter() + duration
+        while time.perf_counter() < deadline:
+            if interval:
+                await asyncio.sleep(interval)
+            path = rnd.choice(paths)
+            extra = extra_headers
+            if revalidate:
+                if path not in etags:
+                    _, headers = await _request(reader, writer, path)
+                    etags[path] = headers.get("etag")
+                if etags[path]:
+                    extra += f"If-None-Match: {etags[path]}\r\n"
+            t0 = time.perf_counter()
+            status, _ = await _request(reader, writer, path, extra)
+            latencies.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+        writer.close()
+
+    await asyncio.gather(*(connection() for _ in range(concurrency)))
+    return latencies, statuses
+
+
+def _client_process(args):
+    return asyncio.run(_client(*args))
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+def start_service(serve, catalog_path, port, serve_args=(), logdir=None):
+    """Start serve.py, in production mode logging into logdir if given"""
+    env = dict(os.environ)
+    if logdir:
+        env["SHUB_LOGDIR"] = logdir
+        env.pop("DEV628cc89a6444", None)
+    else:
+        env["DEV628cc89a6444"] = "1"
+    cmd = [sys.executable, serve, catalog_path]
+    if port != 5003:
+        cmd += ["--port", str(port)]
+    cmd += list(serve_args)
+    t0 = time.time()
+    proc = subprocess.Popen(
+        cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait until it is serving
+    while True:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{cmd} exited with {proc.returncode}")
+        try:
+            asyncio.run(_probe(port))
+            break
+        except OSError:
+            time.sleep(0.05)
+    return proc, time.time() - t0
+
+
+async def _probe(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await _request(reader, writer, "/about")
+    writer.close()
+
+
+def stop_service(proc):
+    proc.terminate()
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def load_test(port, paths, duration, clients, concurrency, revalidate=False):
+    """Run load test against already running service"""
+    with multiprocessing.Pool(clients) as pool:
+        t0 = time.time()
+        results = pool.map(
+            _client_process,
+            [(port, paths, duration, concurrency, revalidate, i)
+             for i in range(clients)])
+        elapsed = time.time() - t0
+    return summarize(results, elapsed)
+
+
+def summarize(results, elapsed):
+    """Summarize (latencies, statuses) from a number of clients"""
+    latencies = sorted(l for r, _ in results for l in r)
+    statuses = {}
+    for _, s in results:
+        for k, v in s.items():
+            statuses[k] = statuses.get(k, 0) + v
+    ms = lambda x: None if x is None else round(x * 1000, 3)
+    return {
+        "requests": len(latencies),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "mean": ms(statistics.mean(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "p999": ms(percentile(latencies, 0.999)),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+@contextlib.contextmanager
+def prepared_catalog(catalog, synthetic, compile_, serve):
+    """Yield catalog data, the path to be served, and label for results"""
+    label = catalog or f"synthetic:{synthetic}"
+    tmpdir = tempfile.mkdtemp(prefix="shub-bench-")
+    try:
+        if catalog:
+            with open(catalog) as f:
+                data = json.load(f)
+        else:
+            data = synthetic_catalog(synthetic)
+            catalog = op.join(tmpdir, "images.json")
+            with open(catalog, "w") as f:
+                json.dump(data, f)
+        served = catalog
+        if compile_ == "sqlite":
+            served = op.join(tmpdir, "images.db")
+            subprocess.run([sys.executable, PROCESS_DUMP, "sqlite", catalog, served],
+                           stdout=subprocess.DEVNULL, check=True)
+            label += " (sqlite)"
+        elif compile_:
+            sys.path.insert(0, op.dirname(op.abspath(serve)))
+            import catalog as catalog_mod
+            served = op.join(tmpdir, "images.idx")
+            catalog_mod.compile_index(catalog, served)
+            label += " (compiled)"
+        yield data, served, tmpdir, label
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def bench_service(serve, served, port, serve_args, paths, duration, clients,
+                  concurrency, revalidate=False, logdir=None):
+    proc, startup = start_service(serve, served, port, serve_args, logdir)
+    try:
+        res = load_test(port, paths, duration, clients, concurrency, revalidate)
+        memory = get_memory(proc.pid)
+    finally:
+        stop_service(proc)
+    return {
+        "serve": serve,
+        "serve_args": list(serve_args),
+        "startup_sec": round(startup, 3),
+        "memory_kb": memory,
+        "clients": clients,
+        "concurrency": concurrency,
+        "revalidate": revalidate,
+        **res,
+    }
+
+
+def save(res, output):
+    print(json.dumps(res, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(res, f, indent=2)
+
+
+def catalog_options(f):
+    for opt in reversed([
+        click.option("--catalog", type=click.Path(exists=True),
+                     help="images.json to serve"),
+        click.option("--synthetic", type=int, default=6000, show_default=True,
+                     help="Number of images in synthetic catalog, if no --catalog"),
+        click.option("--compile", "compile_", flag_value="index",
+                     help="Serve compiled index of the catalog"),
+        click.option("--sqlite", "compile_", flag_value="sqlite",
+                     help="Serve SQLite database made from the catalog"),
+        click.option("--serve", default=SERVE, show_default=True,
+                     help="serve.py to benchmark"),
+        click.option("--serve-arg", multiple=True,
+                     help="Extra option(s) for serve.py"),
+        click.option("--port", type=int, default=5003, show_default=True),
+        click.option("--duration", type=float, default=10, show_default=True,
+                     help="seconds"),
+        click.option("--clients", type=int, default=2, show_default=True,
+                     help="Number of client processes"),
+        click.option("--concurrency", type=int, default=32, show_default=True,
+                     help="Number of connections per client process"),
+        click.option("--output", type=click.Path(),
+                     help="Save results into JSON file"),
+    ]):
+        f = opt(f)
+    return f
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@catalog_options
+@click.option("--revalidate", is_flag=True,
+              help="Send If-None-Match with previously seen ETag's")
+@click.option("--production-logging", is_flag=True,
+              help="Run in production mode, logging into a temporary directory")
+def run(catalog, synthetic, compile_, serve, serve_arg, port, duration,
+        clients, concurrency, output, revalidate, production_logging):
+    """Load test serve.py"""
+    with prepared_catalog(catalog, synthetic, compile_, serve) as (data, served, tmpdir, label):
+        paths = get_paths(data)
+        res = bench_service(serve, served, port, serve_arg, paths, duration,
+                            clients, concurrency, revalidate,
+                            logdir=op.join(tmpdir, "logs") if production_logging else None)
+    save({"catalog": label, "images": len(data["images"]), "paths": len(paths),
+          **res}, output)
+
+
+@main.command()
+@catalog_options
+@click.option("--workers", default="1,2,4,8", show_default=True,
+              help="Comma separated list of numbers of workers to try")
+def scaling(catalog, synthetic, compile_, serve, serve_arg, port, duration,
+            clients, concurrency, output, workers):
+    """Load test serve.py with different numbers of --workers"""
+    runs = []
+    with prepared_catalog(catalog, synthetic, compile_, serve) as (data, served, _, label):
+        paths = get_paths(data)
+        for n in map(int, workers.split(",")):
+            res = bench_service(
+                serve, served, port, list(serve_arg) + ["--workers", str(n)],
+                paths, duration, clients, concurrency)
+            memory = res["memory_kb"]
+            # the first one is the parent, which does not serve when n > 1
+            per_worker = list(memory.values())[1:] if n > 1 else list(memory.values())
+            print(f"workers={n}: {res['rps']} req/sec, "
+                  f"p99={res['latency_ms']['p99']} ms, per worker "
+                  f"pss={[m.get('pss') for m in per_worker]} "
+                  f"private={[m.get('private') for m in per_worker]} kB")
+            runs.append({"workers": n, **res})
+    save({"catalog": label, "images": len(data["images"]), "paths": len(paths),
+          "runs": runs}, output)
+
+
+@main.command()
+@catalog_options
+@click.option("--request-counts", type=click.Path(exists=True, dir_okay=False),
+              default=REQUEST_COUNTS if op.exists(REQUEST_COUNTS) else None,
+              show_default=True,
+              help="logs.apirequestcount.json of the dump to take the mix from")
+@click.option("--mix-size", type=int, default=100000, show_default=True,
+              help="Number of requests in the mix clients pick from at random")
+@click.option("--production-logging", is_flag=True,
+              help="Run in production mode, logging into a temporary directory")
+def mix(catalog, synthetic, compile_, serve, serve_arg, port, duration,
+        clients, concurrency, output, request_counts, mix_size, production_logging):
+    """Load test serve.py with a realistic mix of requests"""
+    with prepared_catalog(catalog, synthetic, compile_, serve) as (data, served, tmpdir, label):
+        paths, shares = request_mix(data, mix_size, request_counts)
+        res = bench_service(serve, served, port, serve_arg, paths, duration,
+                            clients, concurrency,
+                            logdir=op.join(tmpdir, "logs") if production_logging else None)
+    save({"catalog": label, "images": len(data["images"]),
+          "mix": {"source": request_counts or "default", "shares": shares,
+                  "distinct_paths": len(set(paths))},
+          **res}, output)
+
+
+@main.command()
+@catalog_options
+@click.option("--repeat", type=int, default=3, show_default=True,
+              help="Runs of every variant, interleaved. The best one is reported")
+def profiling(catalog, synthetic, compile_, serve, serve_arg, port, duration,
+              clients, concurrency, output, repeat):
+    """Overhead of slow request tracing and of profiling, on the request mix"""
+    variants = {
+        "off": ([], None),
+        "tracing": (["--slow-request", "1"], None),
+        "sampling": ([], "collapsed"),
+        "cprofile": ([], "pstats"),
+    }
+    runs = {v: [] for v in variants}
+    with prepared_catalog(catalog, synthetic, compile_, serve) as (data, served, tmpdir, label):
+        paths, _ = request_mix(data, 100000)
+        for i in range(repeat):
+            for variant, (args, fmt) in variants.items():
+                args = list(serve_arg) + args
+                if fmt:
+                    args += ["--profile-format", fmt, "--profile-dir", tmpdir,
+                             "--profile-seconds", str(duration + 60)]
+                proc, _ = start_service(serve, served, port, args)
+                try:
+                    if fmt:
+                        os.kill(proc.pid, signal.SIGUSR1)
+                    res = load_test(port, paths, duration, clients, concurrency)
+                finally:
+                    stop_service(proc)
+                print(f"{variant} #{i}: {res['rps']} req/sec, "
+                      f"p50={res['latency_ms']['p50']} p99={res['latency_ms']['p99']} ms")
+                runs[variant].append(res)
+    best = {v: max(r, key=lambda x: x["rps"]) for v, r in runs.items()}
+    for variant, res in best.items():
+        res["overhead_pct"] = round(100 * (1 - res["rps"] / best["off"]["rps"]), 1)
+    save({"catalog": label, "images": len(data["images"]), "repeat": repeat,
+          "best": best}, output)
+
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _time(f, repeat):
+    """Return dict with timings of f() and peak of memory allocated by it"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    f()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"min_sec": round(min(times), 4),
+            "median_sec": round(statistics.median(times), 4),
+            "peak_alloc_mb": round(peak / 2**20, 1)}
+
+
+@main.command()
+@click.option("--catalog", type=click.Path(exists=True),
+              help="images.json to build from")
+@click.option("--synthetic", type=int, default=6000, show_default=True,
+              help="Number of images in synthetic catalog, if no --catalog")
+@click.option("--repeat", type=int, default=5, show_default=True)
+@click.option("--output", type=click.Path(),
+              help="Save results into JSON file")
+def build(catalog, synthetic, repeat, output):
+    """Micro-benchmark building the catalog, as serve.py main() does"""
+    sys.path.insert(0, op.dirname(op.abspath(__file__)))
+    import catalog as catalog_mod
+    with prepared_catalog(catalog, synthetic, False, SERVE) as (data, served, tmpdir, label):
+        idx = op.join(tmpdir, "images.idx")
+        steps = {
+            "json_load": lambda: _load_json(served),
+            "prepare_images": lambda: catalog_mod.prepare_images(data["images"]),
+            "load": lambda: catalog_mod.load(served),
+            "load_no_secondary": lambda: catalog_mod.load(served, secondary=False),
+            "load_search": lambda: catalog_mod.load(served, search=True),
+            "compile_index": lambda: catalog_mod.compile_index(served, idx),
+            "load_index": lambda: catalog_mod.load(idx),
+        }
+        res = {"catalog": label, "images": len(data["images"]), "repeat": repeat}
+        for step, f in steps.items():
+            res[step] = _time(f, repeat)
+            print(f"{step}: {res[step]}", file=sys.stderr)
+    save(res, output)
+
+
+@main.command()
+@click.option("--catalog", type=click.Path(exists=True),
+              help="images.json to index")
+@click.option("--synthetic", type=int, default=6000, show_default=True,
+              help="Number of images in synthetic catalog, if no --catalog")
+@click.option("--dump-path", type=click.Path(exists=True, file_okay=False),
+              help="Database dump with labels and stars")
+@click.option("--queries", type=int, default=2000, show_default=True,
+              help="Number of random queries")
+@click.option("--output", type=click.Path(),
+              help="Save results into JSON file")
+def search(catalog, synthetic, dump_path, queries, output):
+    """Time building search index and queries against it, without the service"""
+    sys.path.insert(0, op.dirname(op.abspath(__file__)))
+    import catalog as catalog_mod
+    with prepared_catalog(catalog, synthetic, False, SERVE) as (data, served, _, label):
+        t0 = time.perf_counter()
+        cat = catalog_mod.load(served, search=True, dump_path=dump_path)
+        load_sec = time.perf_counter() - t0
+    index = cat.search
+    rnd = random.Random(0)
+    # terms: substrings of random tokens, some of them combined
+    terms = [t[:rnd.randint(2, len(t))][rnd.randint(0, 1):]
+             for t in rnd.choices(index.tokens, k=queries)]
+    res = {"catalog": label, "docs": len(index.docs), "tokens": len(index.tokens),
+           "load_sec": round(load_sec, 3)}
+    for mode, prefix in (("substring", False), ("prefix", True)):
+        for sort in ("stars", "recent"):
+            for cached in (False, True):
+                if not cached:
+                    index.match.cache_clear()
+                latencies = []
+                for i, term in enumerate(terms):
+                    query = term if i % 3 else f"{term} {terms[i - 1]}"
+                    t0 = time.perf_counter()
+                    index.search(query, sort=sort, prefix=prefix)
+                    latencies.append(time.perf_counter() - t0)
+                latencies.sort()
+                res[f"{mode}/{sort}{'/cached' if cached else ''}"] = {
+                    p: round(percentile(latencies, q) * 1000, 3)
+                    for p, q in (("p50", 0.5), ("p99", 0.99), ("max", 1))
+                }
+    save(res, output)
+
+
+@main.command()
+@catalog_options
+@click.option("--limits", default="--max-in-flight 0;"
+                                 "--max-in-flight 64 --rate-limit 200 --proxies-count 1;"
+                                 "--max-in-flight 64 --rate-limit 200 --proxies-count 1 "
+                                 "--rate-delay 1",
+              show_default=True,
+              help="Semicolon separated serve.py options for admission control "
+                   "to compare")
+@click.option("--polite", type=int, default=8, show_default=True,
+              help="Number of connections of the well-behaved client")
+@click.option("--polite-interval", type=float, default=0.05, show_default=True,
+              help="Seconds the well-behaved client waits between requests on a connection")
+def flood(catalog, synthetic, compile_, serve, serve_arg, port, duration,
+          clients, concurrency, output, limits, polite, polite_interval):
+    """Latency of well-behaved clients while a single client floods the service
+
+    The flooder uses --clients processes with --concurrency connections each,
+    all with the same X-Forwarded-For.
+    """
+    runs = []
+    with prepared_catalog(catalog, synthetic, compile_, serve) as (data, served, _, label):
+        paths = get_paths(data)
+        for limit in limits.split(";"):
+            proc, _ = start_service(serve, served, port, list(serve_arg) + limit.split())
+            try:
+                with multiprocessing.Pool(clients + 1) as pool:
+                    t0 = time.time()
+                    flooding = pool.map_async(
+                        _client_process,
+                        [(port, paths, duration, concurrency, False, i,
+                          "X-Forwarded-For: 10.0.0.1\r\n") for i in range(clients)])
+                    polite_res = pool.apply(_client_process, [
+                        (port, paths, duration, polite, False, -1,
+                         "X-Forwarded-For: 10.0.1.1\r\n",
+                         polite_interval)])
+                    flood_res = flooding.get()
+                    elapsed = time.time() - t0
+                stats = asyncio.run(_get_json(port, "/admission"))
+            finally:
+                stop_service(proc)
+            res = {
+                "serve_args": list(serve_arg) + limit.split(),
+                "polite": summarize([polite_res], elapsed),
+                "flooder": summarize(flood_res, elapsed),
+                "admission": stats,
+            }
+            print(f"{limit}: polite p50={res['polite']['latency_ms']['p50']} "
+                  f"p99={res['polite']['latency_ms']['p99']} ms "
+                  f"{res['polite']['statuses']}, flooder {res['flooder']['rps']} "
+                  f"req/sec {res['flooder']['statuses']}")
+            runs.append(res)
+    save({"catalog": label, "images": len(data["images"]), "paths": len(paths),
+          "runs": runs}, output)
+
+
+async def _get_json(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        k, v = line.decode().split(":", 1)
+        if k.lower() == "content-length":
+            length = int(v)
+    body = await reader.readexactly(length)
+    writer.close()
+    return json.loads(body)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Read-through disk cache of images for serve.py
+
+Images missing from the local tree get fetched from upstream (TOP_URL by
+default) on the first request, into a content-addressed cache:
+
+    objects/<md5[:2]>/MD5E-s<size>--<md5>
+
+md5 and size are those of the record in the catalog.  While it is being
+fetched, all clients requesting the image are served from the partially
+downloaded file as it grows, but the last byte is sent only once md5 and
+size got verified and the entry got published.  So if verification
+fails, clients get their connection aborted instead of a corrupted image,
+and nothing is cached.
+
+There is at most one fetch per image per worker process.  Total size is
+capped, least recently used images get evicted to make room.  The order
+survives restarts since mtime of an image is bumped whenever it is used.
+"""
+
+import asyncio
+import hashlib
+import os
+import os.path as op
+import re
+import shutil
+import time
+from collections import Counter, OrderedDict
+
+import httpx
+from sanic.log import logger
+
+import annex
+
+KEY_REGEX = re.compile(r'^MD5E-s(?P<size>\d+)--(?P<md5>[0-9a-f]{32})$')
+# notify waiting clients at least every that many bytes downloaded
+NOTIFY_EVERY = 1 << 20
+# seconds to connect or wait for data from upstream
+UPSTREAM_TIMEOUT = 60
+
+
+def get_key(md5, size):
+    return f"MD5E-s{size}--{md5}"
+
+
+class Fetch:
+    """Image being fetched from upstream"""
+
+    def __init__(self, md5, size, url, tmp_path):
+        self.md5 = md5
+        self.size = size
+        self.url = url
+        self.key = get_key(md5, size)
+        self.tmp_path = tmp_path
+        self.fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.path = None  # once published
+        # upstream responded with success, or it failed
+        self.started = asyncio.Event()
+        self.progress = asyncio.Event()
+
+    def notify(self):
+        """Wake up everyone waiting for more data"""
+        progress, self.progress = self.progress, asyncio.Event()
+        progress.set()
+
+    def download(self, loop):
+        """Download (in a thread) verifying md5 and size"""
+        md5 = hashlib.md5()
+        notified = 0
+        with httpx.Client(timeout=UPSTREAM_TIMEOUT) as client:
+            with client.stream("GET", self.url) as r:
+                r.raise_for_status()
+                loop.call_soon_threadsafe(self.started.set)
+                for chunk in r.iter_bytes():
+                    if self.written + len(chunk) > self.size:
+                        raise ValueError(
+                            f"{self.url} is larger than expected {self.size} bytes")
+                    view = memoryview(chunk)
+                    while view:
+                        view = view[os.write(self.fd, view):]
+                    md5.update(chunk)
+                    self.written += len(chunk)
+                    if self.written - notified >= NOTIFY_EVERY:
+                        notified = self.written
+                        loop.call_soon_threadsafe(self.notify)
+        if self.written != self.size:
+            raise ValueError(
+                f"{self.url} has {self.written} bytes instead of {self.size}")
+        if md5.hexdigest() != self.md5:
+            raise ValueError(
+                f"{self.url} has md5 {md5.hexdigest()} instead of {self.md5}")
+
+    async def send(self, response, offset, count, executor):
+        """Send the range of the image as it is being downloaded"""
+        end = offset + count
+        if self.error is not None:
+            raise RuntimeError(f"Fetching {self.url} failed: {self.error}")
+        # our own fd, since the fetch closes its one once done
+        fd = os.open(self.path, os.O_RDONLY) if self.done else os.dup(self.fd)
+        try:
+            while offset < end:
+                progress = self.progress
+                if self.error is not None:
+                    raise RuntimeError(f"Fetching {self.url} failed: {self.error}")
+                # the very last byte only once verified
+                available = min(end, self.size if self.done else self.size - 1,
+                                self.written)
+                if available > offset:
+                    await annex.sendfile(response, fd, offset, available - offset,
+                                         executor)
+                    offset = available
+                elif not self.done:
+                    await progress.wait()
+        finally:
+            os.close(fd)
+
+
+class ImageCache:
+
+    def __init__(self, path, max_size, upstream, executor):
+        """
+        Parameters
+        ----------
+        path: str
+          Directory for the cache
+        max_size: int
+          Total size (in bytes) of cached images not to exceed
+        upstream: str
+          Base url to fetch files from
+        executor: Executor
+          To download in
+        """
+        self.path = path
+        self.max_size = max_size
+        self.upstream = upstream.rstrip('/')
+        self.executor = executor
+        self.entries = OrderedDict()  # key: size, least recently used first
+        self.total = 0                # size of entries
+        self.fetches = {}             # key: Fetch
+        self.counts = Counter()
+        self.tmp = op.join(path, 'tmp')
+        # leftovers of fetches interrupted by restart
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.scan()
+
+    def _path(self, key):
+        return op.join(self.path, 'objects', key[-32:-30], key)
+
+    def scan(self):
+        """Load entries from the cache directory"""
+        found = []
+        objects = op.join(self.path, 'objects')
+        os.makedirs(objects, exist_ok=True)
+        for d in os.scandir(objects):
+            for f in os.scandir(d.path):
+                res = KEY_REGEX.match(f.name)
+                st = f.stat()
+                if not res or int(res.group('size')) != st.st_size:
+                    # not ours or truncated by a crash
+                    os.unlink(f.path)
+                    continue
+                found.append((st.st_mtime, f.name, st.st_size))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total += size
+        self.evict(0)
+
+    def evict(self, size):
+        """Evict least recently used entries to fit another one of size
+
+        Returns False if it could not be done.
+        """
+        reserved = sum(f.size for f in self.fetches.values())
+        if size + reserved > self.max_size:
+            return False
+        while self.entries and self.total + reserved + size > self.max_size:
+            key, entry_size = self.entries.popitem(last=False)
+            self.total -= entry_size
+            self.counts['evicted'] += 1
+            try:
+                # whoever is sending it still has it open
+                os.unlink(self._path(key))
+            except OSError as exc:
+                logger.warning("Failed to remove evicted %s: %s", key, exc)
+        return True
+
+    def get(self, md5, size):
+        """Return path to the cached image, or None"""
+        key = get_key(md5, size)
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            # gone underneath us
+            self.total -= self.entries.pop(key)
+            return None
+        self.counts['hits'] += 1
+        return path
+
+    def fetch(self, md5, size, path):
+        """Return Fetch of the image, starting it if not yet, or None if no room"""
+        key = get_key(md5, size)
+        fetch = self.fetches.get(key)
+        if fetch is not None:
+            self.counts['collapsed'] += 1
+            return fetch
+        if not self.evict(size):
+            self.counts['no_room'] += 1
+            return None
+        fetch = self.fetches[key] = Fetch(
+            md5, size, f"{self.upstream}/{path}", op.join(self.tmp, key))
+        self.counts['fetches'] += 1
+        asyncio.ensure_future(self._fetch(fetch))
+        return fetch
+
+    async def _fetch(self, fetch):
+        t0 = time.time()
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                self.executor, fetch.download, asyncio.get_event_loop())
+        except Exception as exc:
+            logger.error("Failed to fetch %s: %s", fetch.url, exc)
+            fetch.error = exc
+            self.counts['failed'] += 1
+            os.unlink(fetch.tmp_path)
+        else:
+            path = self._path(fetch.key)
+            os.makedirs(op.dirname(path), exist_ok=True)
+            os.replace(fetch.tmp_path, path)
+            fetch.path = path
+            self.entries[fetch.key] = fetch.size
+            self.total += fetch.size
+            self.counts['fetched_bytes'] += fetch.size
+            logger.info("Fetched %s (%d bytes) in %.2f sec",
+                        fetch.url, fetch.size, time.time() - t0)
+        finally:
+            del self.fetches[fetch.key]
+            fetch.done = True
+            fetch.started.set()
+            fetch.notify()
+            os.close(fetch.fd)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total,
+            'fetching': len(self.fetches),
+            **{k: self.counts[k] for k in
+               ('hits', 'fetches', 'collapsed', 'failed', 'evicted', 'no_room',
+                'fetched_bytes')},
+        }
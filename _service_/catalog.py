@@ -0,0 +1,667 @@
+"""
+Catalog of images and collections to be served by serve.py
+
+The input is images.json as produced by `_tools_/process_dump.py dump_data`.
+serve.py could use it directly, or it could be "compiled" first
+
+    python _service_/catalog.py compile _data_/images.json _data_/images.idx
+
+into a compact index file which has all names, tags, versions resolved and
+final response bodies already serialized.  serve.py then just mmap's that
+file, so startup is instant and memory is shared (via page cache) among all
+processes using it.
+
+It could also serve an SQLite database produced by
+`_tools_/process_dump.py sqlite`, resolving records of a name only when
+asked for, so its memory use stays flat regardless of the archive size.
+"""
+
+import bisect
+import functools
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import time
+import tracemalloc
+import zlib
+from collections import namedtuple
+
+import click
+# we must produce exactly the same bytes as response.json would
+from sanic.response import json_dumps
+
+# TODO: move from repronim to hub
+# where collections/ and other pages of singularity hub redirect to
+GOTO_URL = "https://datasets.datalad.org/?dir=/shub"
+# it is difference since this is direct url without web ui
+TOP_URL = "https://datasets.datalad.org/shub"
+# Archive is read-only, so records could be cached for long by nginx
+# and clients (ETag would still allow to revalidate)
+CACHE_CONTROL = "public, max-age=604800"
+
+# to ease comparison etc
+FIELDS_ORDER = 'id', 'name', 'branch', 'commit', 'tag', 'version', 'size_mb', 'image', 'build_date'
+
+# ready to be sent response for an image record
+Entry = namedtuple('Entry', 'body etag')
+
+# shorter commit prefixes are not considered
+MIN_COMMIT_PREFIX = 4
+
+
+def make_etag(md5, size, body):
+    """Strong ETag for an image record
+
+    md5 and size of the image itself define it, but a record might still
+    change for the same image (e.g. its path, thus 'image' url, after
+    rename_remove), so we also mix in a checksum of the body.
+    """
+    return f'"{md5}-{size:x}-{zlib.crc32(body):08x}"'
+
+
+def prepare_images(images, top_url=TOP_URL, verbose=False, records=None):
+    """Prepare target complete records to return
+
+    Decided to keep this logic here (and not in process_dump.py) so we could
+    adjust matching without needing to regenerate input file.
+
+    If `records` list is provided, (record, original record from images.json)
+    pairs get appended to it for all records, including those not
+    reachable by any tag, to provide access to fields (such as md5 and size)
+    which do not make it into final records.
+
+    Returns
+    -------
+    dict
+      name: {tag: ready image record}
+    """
+    recs = {}
+    n_latest = 0
+    for name, files in images.items():
+        recs[name] = res = {}  # tag: { ready image record }
+        latest = None
+        for f in files:
+            rec = f.copy()
+            rec['name'] = name
+            rec['image'] = f"{top_url}/{rec.pop('file')}"
+            # order (and "pop") the fields to match the one we observe with
+            # stock singularity hub which we just eagerly got but not needed
+            rec = {
+                _: rec[_] for _ in FIELDS_ORDER if _ in rec
+            }
+            if records is not None:
+                records.append((rec, f))
+            # paranoia
+            if latest is not None and latest['build_date'] == rec['build_date']:
+                raise RuntimeError(f"Found the one with the same date for {rec}")
+            if latest is None or latest['build_date'] < rec['build_date']:
+                latest = rec
+            # what lookups are "supported
+            for id_field in 'tag', 'version':
+                id_ = f[id_field]
+                if id_ in res:
+                    # replace only if build_date is after a known one
+                    # due to use of iso I think string comparison should be
+                    # good enough
+                    if res[id_]['build_date'] > rec['build_date']:
+                        continue  # we do not replace
+                res[id_] = rec
+        if 'latest' not in res:
+            n_latest += 1
+            if verbose:
+                print(f"{n_latest:02d}/{len(images)} {name}: "
+                      f"adding detected 'latest' among {len(files)} records: "
+                      f"tag {latest['tag']} from {latest['build_date']}")
+            res['latest'] = latest
+
+    # strip away all build_date's
+    for _, tags in recs.items():
+        for _, r in tags.items():
+            # could be already gone since we bind the same record across
+            # multiple tags
+            r.pop('build_date', None)
+    for r, _ in records or []:
+        r.pop('build_date', None)
+    return recs
+
+
+class JSONCatalog:
+    """Catalog loaded from images.json and prepared in memory
+
+    Records never change, so we serialize each one only once and keep
+    ready to be sent Entry's.  Besides tags (and versions) as resolved by
+    prepare_images, records are also indexed by
+
+    - md5 of the image (across all images)
+    - tag@version
+    - commit, so they could be looked up by a unique commit prefix
+
+    with newer builds taking precedence as for tags.
+
+    Optionally it also has a search.SearchIndex over all records.
+    """
+
+    search = None
+
+    def __init__(self, images, collections, records, secondary=True):
+        self.images = images            # name: {tag: record}
+        self.collections = collections  # str(pk): {'full_name': ..., ...}
+        # a record is shared among tags, so serialize each one only once
+        entries = {
+            id(rec): Entry(body, make_etag(orig['md5'], orig['size'], body))
+            for rec, orig in records
+            for body in [json_dumps(rec).encode()]
+        }
+        self.entries = {                # name: {tag: Entry}
+            name: {tag: entries[id(rec)] for tag, rec in tags.items()}
+            for name, tags in images.items()
+        }
+        self.digests = {}               # md5: Entry
+        self.tag_versions = {}          # name: {tag@version: Entry}
+        self.commits = {}               # name: ([sorted commits], [Entry])
+        if secondary:
+            self.index_records(records, entries)
+
+    def index_records(self, records, entries):
+        """Build secondary indexes"""
+        commits = {}
+        # sorting is stable, so for the same date the later one wins as in
+        # prepare_images
+        for rec, orig in sorted(records, key=lambda r: r[1]['build_date']):
+            entry = entries[id(rec)]
+            name = rec['name']
+            self.digests[orig['md5']] = entry
+            self.tag_versions.setdefault(name, {})[
+                f"{orig['tag']}@{orig['version']}"] = entry
+            commits.setdefault(name, {})[orig['commit']] = entry
+        for name, entries in commits.items():
+            keys = sorted(entries)
+            self.commits[name] = (keys, [entries[k] for k in keys])
+
+    @classmethod
+    def load(cls, path, verbose=False, secondary=True, search=False, dump_path=None,
+             top_url=TOP_URL):
+        """Load images.json
+
+        If `search`, also build search index, enriched with stars and labels
+        from the database dump under `dump_path` if given.  Image urls in
+        records point under `top_url`.
+        """
+        with open(path) as f:
+            raw = json.load(f)
+        assert set(raw) == {'images', 'collections'}
+        records = []
+        images = prepare_images(raw['images'], top_url=top_url, verbose=verbose,
+                                records=records)
+        cat = cls(images, raw['collections'], records, secondary=secondary)
+        if search:
+            from search import SearchIndex, load_dump_extras
+            stars, labels = load_dump_extras(dump_path) if dump_path else ({}, {})
+            cat.search = SearchIndex(records, raw['collections'], stars, labels)
+        return cat
+
+    def lookup(self, name, tag):
+        """Return Entry for the name:tag, or None"""
+        tags = self.entries.get(name, None)
+        if tags:
+            return tags.get(tag)
+
+    def lookup_tag_version(self, name, tag, version):
+        """Return Entry for the name:tag@version, or None"""
+        return self.tag_versions.get(name, {}).get(f"{tag}@{version}")
+
+    def lookup_commit(self, name, prefix):
+        """Return Entry for the commit of the name, or None
+
+        prefix must be unique among the commits of the name.
+        """
+        if len(prefix) < MIN_COMMIT_PREFIX or name not in self.commits:
+            return None
+        commits, entries = self.commits[name]
+        i = bisect.bisect_left(commits, prefix)
+        if i < len(commits) and commits[i].startswith(prefix):
+            if i + 1 < len(commits) and commits[i + 1].startswith(prefix):
+                return None  # ambiguous
+            return entries[i]
+
+    def lookup_digest(self, md5):
+        """Return Entry for the image with md5, or None"""
+        return self.digests.get(md5)
+
+    def collection(self, pk):
+        """Return full_name of the collection, or None"""
+        return (self.collections.get(str(pk)) or {}).get('full_name')
+
+    def counts(self):
+        """Return {what: number of such records}"""
+        return {
+            'tags': sum(len(tags) for tags in self.entries.values()),
+            'digests': len(self.digests),
+            'collections': len(self.collections),
+        }
+
+
+#
+# Compiled index
+#
+# Layout (all integers little endian):
+#
+#   header:   MAGIC, version (I), number of sections (I)
+#   sections: name (16s), number of entries (I), offset of entries table (Q)
+#   entries:  key offset (Q), key length (I), value offset (Q), value length (I)
+#             sorted by key, so we could bisect straight in the mmap
+#   blobs:    keys and values
+#
+# Sections:
+#   images        b"<name>\0<tag>" -> Entry (shared among tags), packed as
+#                 etag length (B), etag, body
+#   tag_versions  b"<name>\0<tag>@<version>" -> Entry
+#   commits       b"<name>\0<commit>" -> Entry
+#   digests       b"<md5>" -> Entry
+#   collections   b"<pk>" -> full_name
+#
+MAGIC = b"SHUBIDX\0"
+VERSION = 3
+_HEADER = struct.Struct("<8sII")
+_SECTION = struct.Struct("<16sIQ")
+_ENTRY = struct.Struct("<QIQI")
+
+# SQLite database as produced by `_tools_/process_dump.py sqlite`
+SQLITE_MAGIC = b"SQLite format 3\0"
+# number of names SQLiteCatalog keeps resolved
+SQLITE_CACHE_SIZE = 4096
+
+
+def _image_key(name, tag):
+    return f"{name}\0{tag}".encode()
+
+
+def _pack_entry(entry):
+    etag = entry.etag.encode()
+    return bytes([len(etag)]) + etag + entry.body
+
+
+def _unpack_entry(value):
+    n = value[0]
+    return Entry(value[1 + n:], value[1:1 + n].decode())
+
+
+def compile_index(json_path, output, verbose=False, top_url=TOP_URL):
+    """Compile images.json into an index file to be used by IndexCatalog
+
+    Output is written to a temporary file and renamed, so a running service
+    never sees a partially written index.
+    """
+    cat = JSONCatalog.load(json_path, verbose=verbose, top_url=top_url)
+
+    images = {
+        _image_key(name, tag): _pack_entry(entry)
+        for name, tags in cat.entries.items()
+        for tag, entry in tags.items()
+    }
+    tag_versions = {
+        _image_key(name, tag_version): _pack_entry(entry)
+        for name, tags in cat.tag_versions.items()
+        for tag_version, entry in tags.items()
+    }
+    commits = {
+        _image_key(name, commit): _pack_entry(entry)
+        for name, (keys, entries) in cat.commits.items()
+        for commit, entry in zip(keys, entries)
+    }
+    digests = {
+        md5.encode(): _pack_entry(entry)
+        for md5, entry in cat.digests.items()
+    }
+    collections = {
+        str(pk).encode(): r['full_name'].encode()
+        for pk, r in cat.collections.items()
+        if r.get('full_name')
+    }
+    sections = {
+        'images': images,
+        'tag_versions': tag_versions,
+        'commits': commits,
+        'digests': digests,
+        'collections': collections,
+    }
+
+    blobs = bytearray()
+    values = {}  # body: offset, to store shared bodies only once
+
+    def add_blob(b, dedup=False):
+        if dedup and b in values:
+            return values[b]
+        off = len(blobs)
+        blobs.extend(b)
+        if dedup:
+            values[b] = off
+        return off
+
+    tables = []
+    for secname, entries in sections.items():
+        table = bytearray()
+        for key in sorted(entries):
+            value = entries[key]
+            table.extend(_ENTRY.pack(
+                add_blob(key), len(key),
+                add_blob(value, dedup=True), len(value)))
+        tables.append((secname, len(entries), table))
+
+    # now we know sizes, so could compute final offsets
+    start = _HEADER.size + _SECTION.size * len(tables)
+    tables_size = sum(len(t) for _, _, t in tables)
+    blobs_start = start + tables_size
+
+    tmp = f"{output}.tmp{os.getpid()}"
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(tables)))
+        off = start
+        for secname, n, table in tables:
+            f.write(_SECTION.pack(secname.encode(), n, off))
+            off += len(table)
+        for _, n, table in tables:
+            # entries hold offsets relative to blobs start - adjust
+            for i in range(n):
+                ko, kl, vo, vl = _ENTRY.unpack_from(table, i * _ENTRY.size)
+                _ENTRY.pack_into(table, i * _ENTRY.size,
+                                 ko + blobs_start, kl, vo + blobs_start, vl)
+            f.write(table)
+        f.write(blobs)
+    os.replace(tmp, output)
+    return {secname: n for secname, n, _ in tables}
+
+
+class _Section:
+    """Sorted table of entries within the mmap'ed index"""
+
+    def __init__(self, mm, n, offset):
+        self.mm = mm
+        self.n = n
+        self.offset = offset
+
+    def _key(self, i):
+        ko, kl, _, _ = _ENTRY.unpack_from(self.mm, self.offset + i * _ENTRY.size)
+        return self.mm[ko:ko + kl]
+
+    def _value(self, i):
+        _, _, vo, vl = _ENTRY.unpack_from(self.mm, self.offset + i * _ENTRY.size)
+        return self.mm[vo:vo + vl]
+
+    def _bisect(self, key):
+        """Index of the first entry with the key >= given one"""
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, key):
+        i = self._bisect(key)
+        if i < self.n and self._key(i) == key:
+            return self._value(i)
+
+    def get_by_prefix(self, prefix):
+        """Return value for the only key starting with the prefix, or None"""
+        i = self._bisect(prefix)
+        if i < self.n and self._key(i).startswith(prefix):
+            if i + 1 < self.n and self._key(i + 1).startswith(prefix):
+                return None  # ambiguous
+            return self._value(i)
+
+
+class IndexCatalog:
+    """Catalog served straight from an mmap'ed index produced by compile_index
+
+    It has no search index.
+    """
+
+    search = None
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, nsections = _HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a compiled shub index")
+        if version != VERSION:
+            raise ValueError(
+                f"{path} has index version {version} whenever we support "
+                f"{VERSION}. Recompile it")
+        self.sections = {}
+        for i in range(nsections):
+            name, n, offset = _SECTION.unpack_from(
+                self.mm, _HEADER.size + i * _SECTION.size)
+            self.sections[name.rstrip(b"\0").decode()] = _Section(self.mm, n, offset)
+
+    @classmethod
+    def load(cls, path, verbose=False, **kwargs):
+        return cls(path)
+
+    def _lookup(self, section, key):
+        value = self.sections[section].get(key)
+        if value is not None:
+            return _unpack_entry(value)
+
+    def lookup(self, name, tag):
+        """Return Entry for the name:tag, or None"""
+        return self._lookup('images', _image_key(name, tag))
+
+    def lookup_tag_version(self, name, tag, version):
+        """Return Entry for the name:tag@version, or None"""
+        return self._lookup('tag_versions', _image_key(name, f"{tag}@{version}"))
+
+    def lookup_commit(self, name, prefix):
+        """Return Entry for the commit of the name, or None
+
+        prefix must be unique among the commits of the name.
+        """
+        if len(prefix) < MIN_COMMIT_PREFIX:
+            return None
+        value = self.sections['commits'].get_by_prefix(_image_key(name, prefix))
+        if value is not None:
+            return _unpack_entry(value)
+
+    def lookup_digest(self, md5):
+        """Return Entry for the image with md5, or None"""
+        return self._lookup('digests', md5.encode())
+
+    def collection(self, pk):
+        """Return full_name of the collection, or None"""
+        full_name = self.sections['collections'].get(str(pk).encode())
+        if full_name is not None:
+            return full_name.decode()
+
+    def counts(self):
+        """Return {what: number of such records}"""
+        return {
+            'tags': self.sections['images'].n,
+            'digests': self.sections['digests'].n,
+            'collections': self.sections['collections'].n,
+        }
+
+
+class SQLiteCatalog:
+    """Catalog answering lookups from SQLite database (process_dump.py sqlite)
+
+    Nothing is loaded upfront.  Records of a name are fetched (with the same
+    statements, which sqlite3 keeps prepared) and resolved as in
+    prepare_images when first asked for, and kept for a number of most
+    recently used names.  So memory use does not grow with the archive.
+
+    It has no search index.
+    """
+
+    search = None
+
+    def __init__(self, path, top_url=TOP_URL, cache_size=SQLITE_CACHE_SIZE):
+        self.path = path
+        self.top_url = top_url
+        self._pid = self._db = None
+        self._get_name = functools.lru_cache(cache_size)(self._load_name)
+        # fail early if it is not a catalog
+        self.db.execute("SELECT 1 FROM images, collections LIMIT 1")
+        self._counts = None
+
+    @classmethod
+    def load(cls, path, verbose=False, top_url=TOP_URL, **kwargs):
+        return cls(path, top_url=top_url)
+
+    @property
+    def db(self):
+        # connection must not be shared with forked workers
+        if self._pid != os.getpid():
+            # the file is only ever replaced as a whole, never written in
+            # place, so no locking nor -wal/-shm files are needed
+            self._db = sqlite3.connect(
+                f"file:{self.path}?mode=ro&immutable=1", uri=True,
+                check_same_thread=False)
+            self._pid = os.getpid()
+        return self._db
+
+    def _load_name(self, name):
+        """Return JSONCatalog with just that name, or None if not known"""
+        rows = self.db.execute(
+            "SELECT rec FROM images WHERE name = ? ORDER BY rowid", (name,)).fetchall()
+        if not rows:
+            return None
+        records = []
+        images = prepare_images({name: [json.loads(rec) for rec, in rows]},
+                                top_url=self.top_url, records=records)
+        return JSONCatalog(images, {}, records)
+
+    def lookup(self, name, tag):
+        """Return Entry for the name:tag, or None"""
+        cat = self._get_name(name)
+        if cat is not None:
+            return cat.lookup(name, tag)
+
+    def lookup_tag_version(self, name, tag, version):
+        """Return Entry for the name:tag@version, or None"""
+        cat = self._get_name(name)
+        if cat is not None:
+            return cat.lookup_tag_version(name, tag, version)
+
+    def lookup_commit(self, name, prefix):
+        """Return Entry for the commit of the name, or None
+
+        prefix must be unique among the commits of the name.
+        """
+        cat = self._get_name(name)
+        if cat is not None:
+            return cat.lookup_commit(name, prefix)
+
+    def lookup_digest(self, md5):
+        """Return Entry for the image with md5, or None"""
+        # the newest one (the last one among the same date) as JSONCatalog does
+        row = self.db.execute(
+            "SELECT name FROM images WHERE md5 = ? "
+            "ORDER BY build_date DESC, rowid DESC LIMIT 1", (md5,)).fetchone()
+        if row is not None:
+            return self._get_name(row[0]).lookup_digest(md5)
+
+    def collection(self, pk):
+        """Return full_name of the collection, or None"""
+        try:
+            pk = int(pk)
+        except ValueError:
+            return None
+        row = self.db.execute(
+            "SELECT full_name FROM collections WHERE pk = ?", (pk,)).fetchone()
+        return row and row[0]
+
+    def counts(self):
+        """Return {what: number of such records}"""
+        if self._counts is None:
+            # all tags and versions, plus latest (synthesized if not tagged)
+            (tags,), = self.db.execute(
+                "SELECT COUNT(*) FROM (SELECT name, tag FROM images "
+                "UNION SELECT name, version FROM images "
+                "UNION SELECT name, 'latest' FROM images)")
+            (digests,), = self.db.execute("SELECT COUNT(DISTINCT md5) FROM images")
+            (collections,), = self.db.execute("SELECT COUNT(*) FROM collections")
+            self._counts = {'tags': tags, 'digests': digests, 'collections': collections}
+        return self._counts
+
+    def cache_info(self):
+        return self._get_name.cache_info()
+
+
+def image_size(cat, md5):
+    """Return size of the image with md5 as known to the catalog, or None
+
+    It is not in the record, but ETag of the record carries it.
+    """
+    entry = cat.lookup_digest(md5)
+    if entry is not None:
+        return int(entry.etag.strip('"').split('-')[1], 16)
+
+
+def is_index(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def is_sqlite(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+
+
+def load(path, verbose=False, **kwargs):
+    """Load catalog from either images.json, a compiled index or SQLite database
+
+    kwargs are passed to JSONCatalog.load, only top_url is used for SQLite
+    database, and all are ignored for a compiled index.
+    """
+    cls = (IndexCatalog if is_index(path)
+           else SQLiteCatalog if is_sqlite(path)
+           else JSONCatalog)
+    return cls.load(path, verbose=verbose, **kwargs)
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command("compile")
+@click.argument("json_path", type=click.Path(exists=True, file_okay=True))
+@click.argument("output", type=click.Path(exists=False, file_okay=True))
+@click.option("--top-url", default=TOP_URL, show_default=True,
+              help="Base url for image urls in records, e.g. image/ endpoint "
+                   "of serve.py serving them from a local tree")
+def compile_(json_path, output, top_url):
+    """Compile images.json into an index to be mmap'ed by serve.py"""
+    t0 = time.time()
+    counts = compile_index(json_path, output, top_url=top_url)
+    print(f"INFO: compiled {counts} into {output} "
+          f"({os.path.getsize(output)} bytes) in {time.time() - t0:.2f} sec")
+
+
+@main.command()
+@click.argument("json_path", type=click.Path(exists=True, file_okay=True))
+def stats(json_path):
+    """Report sizes and memory (as traced by tracemalloc) of the catalog"""
+    memory = {}
+    for secondary in False, True:
+        tracemalloc.start()
+        t0 = time.time()
+        cat = JSONCatalog.load(json_path, secondary=secondary)
+        memory[secondary] = tracemalloc.get_traced_memory()[0] / 2**20
+        tracemalloc.stop()
+        print(f"Loaded {'with' if secondary else 'without'} secondary indexes "
+              f"in {time.time() - t0:.2f} sec: {memory[secondary]:.1f} MB")
+    print(f"{len(cat.images)} images, "
+          f"{sum(map(len, cat.entries.values()))} tags, "
+          f"{len(cat.digests)} digests, "
+          f"{sum(map(len, cat.tag_versions.values()))} tag@version's, "
+          f"{sum(len(c[0]) for c in cat.commits.values())} commits. "
+          f"Secondary indexes take {memory[True] - memory[False]:.1f} MB")
+
+if __name__ == "__main__":
+    main()
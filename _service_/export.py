@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Export answers of serve.py for the front proxy (nginx) to serve directly
+
+The catalog is immutable, so `generate` precomputes (with the same
+catalog.load as serve.py) what serve.py would respond with
+
+- a tree of static JSON files, one per container/<name>[:<tag>] for every
+  tag (and version) and the bare name for latest, byte to byte the same
+  as served records,
+- nginx map from collections/<pk> to the url it redirects to,
+
+plus nginx.conf snippet to include into the server {} to use them and
+forward anything else (tag@version, @commit, digest/ etc) to serve.py, e.g.
+
+    _service_/export.py generate _data_/images.json /srv/shub-static
+
+`check` compares all generated answers against the running serve.py.
+"""
+
+import asyncio
+import os
+import os.path as op
+import shutil
+import sys
+import time
+from urllib.parse import quote
+
+import click
+import httpx
+
+import catalog
+
+# under which nginx location serve.py is proxied
+PREFIX = "api"
+NGINX_CONF = """\
+# generated by _service_/export.py from {json_path}
+# map {{}} is valid only within http {{}}, include it there:
+#   include {output}/collections.map;
+# and this one within the server {{}}:
+location ^~ /{prefix}/container/ {{
+    root {output}/static;
+    default_type application/json;
+    add_header Cache-Control "{cache_control}";
+    try_files $uri @shub;
+}}
+location ~ ^/{prefix}/collections/\\d+$ {{
+    if ($shub_collection) {{
+        return 302 $shub_collection;
+    }}
+    try_files /nonexistent @shub;
+}}
+location ~ ^/{prefix}/(|about|collections/my|labels)$ {{
+    return 302 {goto_url};
+}}
+location @shub {{
+    rewrite ^/{prefix}/(.*)$ /$1 break;
+    proxy_pass {upstream};
+    proxy_set_header Host $host;
+    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+}}
+"""
+
+
+def nginx_quote(s):
+    """Quote a string for nginx config"""
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def write_tree(cat, static):
+    """Write JSON file for every name:tag and name (latest). Return number of files"""
+    n = 0
+    for name, tags in cat.entries.items():
+        org, repo = name.split('/')
+        d = op.join(static, PREFIX, 'container', org)
+        os.makedirs(d, exist_ok=True)
+        for tag, entry in tags.items():
+            if '/' in tag or tag.startswith('.'):
+                # could not be a file, serve.py would take care
+                continue
+            with open(op.join(d, f"{repo}:{tag}"), 'wb') as f:
+                f.write(entry.body)
+            n += 1
+            if tag == 'latest':
+                with open(op.join(d, repo), 'wb') as f:
+                    f.write(entry.body)
+                n += 1
+    return n
+
+
+def write_map(cat, path):
+    """Write nginx map for collections/. Return number of entries"""
+    n = 0
+    with open(path, 'w') as f:
+        f.write("map $uri $shub_collection {\n    default \"\";\n")
+        for pk in sorted(cat.collections, key=int):
+            full_name = cat.collection(pk)
+            if full_name:
+                uri = f"/{PREFIX}/collections/{pk}"
+                f.write(f"    {uri} {nginx_quote(f'{catalog.GOTO_URL}/{full_name}')};\n")
+                n += 1
+        f.write("}\n")
+    return n
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument("json_path", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(file_okay=False))
+@click.option("--upstream", default="http://127.0.0.1:5003", show_default=True,
+              help="serve.py for nginx to forward the rest to")
+@click.option("--top-url", default=catalog.TOP_URL, show_default=True,
+              help="Base url for image urls in records, as for serve.py --image-url")
+def generate(json_path, output, upstream, top_url):
+    """Generate static files and nginx map and config for them into OUTPUT
+
+    OUTPUT is replaced as a whole only once everything is generated.
+    """
+    t0 = time.time()
+    cat = catalog.JSONCatalog.load(json_path, secondary=False, top_url=top_url)
+    output = op.abspath(output)
+    tmp = f"{output}.tmp-{os.getpid()}"
+    os.makedirs(tmp)
+    try:
+        n_files = write_tree(cat, op.join(tmp, 'static'))
+        n_map = write_map(cat, op.join(tmp, 'collections.map'))
+        with open(op.join(tmp, 'nginx.conf'), 'w') as f:
+            f.write(NGINX_CONF.format(
+                json_path=op.abspath(json_path), output=output, prefix=PREFIX,
+                cache_control=catalog.CACHE_CONTROL, goto_url=catalog.GOTO_URL,
+                upstream=upstream))
+        if op.exists(output):
+            old = f"{output}.old-{os.getpid()}"
+            os.rename(output, old)
+            os.rename(tmp, output)
+            shutil.rmtree(old)
+        else:
+            os.rename(tmp, output)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    print(f"INFO: generated {n_files} files and {n_map} collections into "
+          f"{output} in {time.time() - t0:.1f} sec. See {output}/nginx.conf")
+
+
+def expected(output):
+    """Generate (path, status, body or location) for all generated answers"""
+    root = op.join(output, 'static', PREFIX)
+    for org in sorted(os.listdir(op.join(root, 'container'))):
+        d = op.join(root, 'container', org)
+        for f in sorted(os.listdir(d)):
+            with open(op.join(d, f), 'rb') as fp:
+                yield f"container/{org}/{f}", 200, fp.read()
+    with open(op.join(output, 'collections.map')) as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if len(parts) == 2 and parts[0].startswith('/'):
+                value = parts[1].strip().rstrip(';')
+                location = value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                yield parts[0][len(PREFIX) + 2:], 302, location
+
+
+async def _check(url, answers, concurrency):
+    mismatches = []
+    n = 0
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        queue = asyncio.Queue(concurrency * 2)
+
+        async def worker():
+            nonlocal n
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                path, status, expect = item
+                r = await client.get(quote(path, safe="/:@"), allow_redirects=False)
+                got = r.content if status == 200 else r.headers.get("location")
+                if r.status_code != status or got != expect:
+                    mismatches.append((path, status, r.status_code))
+                    print(f"MISMATCH: {path}: expected {status}, got {r.status_code}"
+                          f"{' with different content' if r.status_code == status else ''}")
+                n += 1
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        for item in answers:
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    return n, mismatches
+
+
+@main.command()
+@click.argument("output", type=click.Path(exists=True, file_okay=False))
+@click.option("--url", default="http://127.0.0.1:5003", show_default=True,
+              help="Running serve.py to compare against")
+@click.option("-j", "--concurrency", type=int, default=16, show_default=True)
+def check(output, url, concurrency):
+    """Compare everything generated into OUTPUT against serve.py"""
+    t0 = time.time()
+    n, mismatches = asyncio.run(_check(url, expected(output), concurrency))
+    print(f"INFO: checked {n} answers in {time.time() - t0:.1f} sec, "
+          f"{len(mismatches)} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
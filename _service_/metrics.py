@@ -0,0 +1,87 @@
+"""
+Metrics of serve.py in Prometheus text format
+
+Recording is just a few dict/list increments per request, so it could stay
+on in production.  Metrics are per worker process, so better be scraped
+from a service running a single worker.
+"""
+
+import bisect
+from collections import Counter, defaultdict
+
+# seconds
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5)
+LAG_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is for +Inf
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels=""):
+        """Yield lines of samples, labels being e.g. 'route="container",'"""
+        total = 0
+        for le, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels}le="{le}"}} {total}'
+        labels = f"{{{labels.rstrip(',')}}}" if labels else ""
+        yield f'{name}_sum{labels} {self.sum}'
+        yield f'{name}_count{labels} {total}'
+
+
+latency = defaultdict(Histogram)  # route: Histogram
+responses = Counter()             # (route, status): count
+resolutions = Counter()           # how container/ got resolved: count
+loop_lag = Histogram(LAG_BUCKETS)
+
+
+def observe(route, status, seconds):
+    latency[route].observe(seconds)
+    responses[(route, status)] += 1
+
+
+def _header(name, type_, help_):
+    return [f"# HELP {name} {help_}", f"# TYPE {name} {type_}"]
+
+
+def render(gauges=(), counters=()):
+    """Render all metrics, plus gauges and counters as in render_extra"""
+    lines = _header("shub_request_duration_seconds", "histogram",
+                    "Time from receiving a request until it is responded to")
+    for route, hist in sorted(latency.items()):
+        lines.extend(hist.render("shub_request_duration_seconds", f'route="{route}",'))
+    lines += _header("shub_responses_total", "counter", "Responses by route and status")
+    for (route, status), count in sorted(responses.items()):
+        lines.append(f'shub_responses_total{{route="{route}",status="{status}"}} {count}')
+    lines += _header("shub_resolutions_total", "counter",
+                     "Found containers by how they were resolved")
+    for via, count in sorted(resolutions.items()):
+        lines.append(f'shub_resolutions_total{{via="{via}"}} {count}')
+    lines += _header("shub_event_loop_lag_seconds", "histogram",
+                     "How late the event loop wakes up a sleeping task")
+    lines.extend(loop_lag.render("shub_event_loop_lag_seconds"))
+    lines.append("")
+    return "\n".join(lines) + render_extra(gauges, counters)
+
+
+def render_extra(gauges=(), counters=()):
+    """Render gauges and counters given as (name, help, {labels: value})
+
+    labels are given as e.g. 'reason="rate"' or "" for none.
+    """
+    lines = []
+    for type_, metrics in (("gauge", gauges), ("counter", counters)):
+        for name, help_, values in metrics:
+            lines += _header(name, type_, help_)
+            for labels, value in values.items():
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,154 @@
+"""
+On-demand profiling and slow request tracing for serve.py
+
+Nothing runs unless asked for.  A profile of a worker is taken only when
+an operator sends it SIGUSR1, e.g.
+
+    kill -USR1 <worker pid>        # or -<process group id> for all workers
+
+which, for --profile-seconds, either samples the stack of the event loop
+thread from a background thread (collapsed stacks, one "frame;frame;... count"
+line per stack, as flamegraph.pl and speedscope take them), or runs
+cProfile in it (pstats, for python -m pstats or snakeviz).
+
+Handlers could mark the end of their phases (lookup, response etc) with
+Phases, and requests which took longer than --slow-request are logged with
+those phases, as well as with the time before the handler got to them
+("wait") and after it was done ("after", middleware).
+"""
+
+import cProfile
+import os
+import os.path as op
+import sys
+import threading
+import time
+from collections import Counter
+
+from sanic.log import logger
+
+# seconds between samples of the stack
+SAMPLE_INTERVAL = 0.005
+FORMATS = ("collapsed", "pstats")
+
+# path of the one running in this process, if any
+_active = None
+# code object: its label in stacks
+_labels = {}
+
+
+def _frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = \
+            f"{code.co_name} ({op.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+class SamplingProfiler(threading.Thread):
+    """Samples the stack of a thread until stopped, counting collapsed stacks"""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(name="profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def start(loop, seconds, outdir, fmt="collapsed"):
+    """Profile this process (its event loop thread) for that many seconds
+
+    Must be called from within the loop thread.  Returns the path the
+    profile will be written into, or None if already profiling.
+    """
+    global _active
+    if _active is not None:
+        logger.warning("Already profiling into %s", _active)
+        return None
+    path = op.join(outdir, "shub-profile-%d-%s.%s" % (
+        os.getpid(), time.strftime("%Y%m%d-%H%M%S"), fmt))
+    if fmt == "pstats":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = SamplingProfiler(threading.get_ident())
+        profiler.start()
+    _active = path
+    logger.info("Profiling (%s) for %s sec into %s", fmt, seconds, path)
+
+    def finish():
+        global _active
+        try:
+            if fmt == "pstats":
+                profiler.disable()
+                profiler.dump_stats(path + ".tmp")
+                what = ""
+            else:
+                profiler.stop()
+                profiler.write(path + ".tmp")
+                what = f" ({profiler.samples} samples)"
+            os.replace(path + ".tmp", path)
+            logger.info("Wrote profile%s into %s", what, path)
+        except OSError as exc:
+            logger.error("Failed to write profile into %s: %s", path, exc)
+        finally:
+            _active = None
+
+    loop.call_later(seconds, finish)
+    return path
+
+
+class Phases:
+    """Durations of phases of handling a request, to log it if slow"""
+    __slots__ = ("last", "durations")
+
+    def __init__(self, request):
+        # since the request got received
+        self.last = request.received
+        self.durations = []
+        request.ctx.phases = self
+        self.mark("wait")
+
+    def mark(self, phase):
+        """Record that phase just ended"""
+        now = time.perf_counter()
+        self.durations.append((phase, now - self.last))
+        self.last = now
+
+
+def log_if_slow(request, status, threshold):
+    """Log the request (and its phases) if it took more than threshold seconds"""
+    now = time.perf_counter()
+    total = now - request.received
+    if total < threshold:
+        return
+    phases = getattr(request.ctx, "phases", None)
+    breakdown = ""
+    if phases is not None:
+        breakdown = " ".join(
+            f"{phase}={d * 1000:.1f}" for phase, d in
+            phases.durations + [("after", now - phases.last)])
+        breakdown = f" ({breakdown} ms)"
+    logger.warning("Slow request: %s %s -> %s took %.1f ms%s",
+                   request.method, request.path, status, total * 1000, breakdown)
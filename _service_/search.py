@@ -0,0 +1,190 @@
+"""
+Search index over the catalog for the /search endpoint of serve.py
+
+Every image record (including older builds) is a document with tokens from
+its org, repo, tag and license of the collection, and optionally labels of
+the container from the database dump (main.label.json).  Number of stars of
+the collection (main.star.json) could be used for ranking.
+
+Query terms are matched as substrings (or prefixes) of the tokens.  To not
+scan all tokens, substring matching goes through a trigram index of tokens,
+and prefix matching bisects the sorted list of tokens.  Rankings are
+precomputed, so a page of results is just a partial sort of the matches.
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import re
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+
+TOKEN_REGEX = re.compile(r'[0-9a-z]+')
+# longer are unlikely to be searched for, e.g. checksums in labels
+MAX_TOKEN = 40
+SORTS = 'stars', 'recent', 'name'
+
+
+def tokenize(text):
+    return [t for t in TOKEN_REGEX.findall(str(text).lower()) if len(t) <= MAX_TOKEN]
+
+
+def trigrams(token):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+def get_license(license):
+    """License is what GitHub API gave, so could be a record"""
+    if isinstance(license, dict):
+        return license.get('spdx_id') or license.get('name') or license.get('key')
+    return license
+
+
+def load_dump_extras(dump_path):
+    """Load stars per collection and labels per container from the database dump
+
+    Returns
+    -------
+    dict, dict
+      {collection pk: number of stars}, {container pk: ["key=value", ...]}
+    """
+    dump_path = Path(dump_path)
+    stars = defaultdict(int)
+    labels = defaultdict(list)
+    star_path = dump_path / "main.star.json"
+    if star_path.exists():
+        with star_path.open() as f:
+            for r in json.load(f):
+                collection = (r.get('fields') or {}).get('collection')
+                if collection is not None:
+                    stars[int(collection)] += 1
+    label_path = dump_path / "main.label.json"
+    if label_path.exists():
+        with label_path.open() as f:
+            for r in json.load(f):
+                fields = r.get('fields') or {}
+                label = f"{fields.get('key')}={fields.get('value')}"
+                for container in fields.get('containers') or []:
+                    labels[int(container)].append(label)
+    return dict(stars), dict(labels)
+
+
+class SearchIndex:
+
+    def __init__(self, records, collections, stars=None, labels=None):
+        """
+        Parameters
+        ----------
+        records: list
+          (record, original record) pairs as collected by catalog.prepare_images
+        collections: dict
+          str(pk): collection record
+        stars: dict, optional
+          collection pk: number of stars
+        labels: dict, optional
+          container pk: list of labels
+        """
+        stars = stars or {}
+        labels = labels or {}
+        self.docs = []
+        postings = defaultdict(set)
+        for rec, orig in records:
+            i = len(self.docs)
+            collection = collections.get(str(orig['collection'])) or {}
+            license = get_license(collection.get('license'))
+            self.docs.append({
+                'uri': f"shub://{rec['name']}:{orig['tag']}",
+                'name': rec['name'],
+                'tag': orig['tag'],
+                'version': orig['version'],
+                'build_date': orig['build_date'],
+                'license': license,
+                'stars': stars.get(int(orig['collection']), 0),
+            })
+            text = [rec['name'], orig['tag'], license or '']
+            text.extend(labels.get(rec['id'], []))
+            for t in tokenize(' '.join(text)):
+                postings[t].add(i)
+        self.tokens = sorted(postings)
+        self.postings = [frozenset(postings[t]) for t in self.tokens]
+        trigram_tokens = defaultdict(set)
+        for ti, t in enumerate(self.tokens):
+            for tg in trigrams(t):
+                trigram_tokens[tg].add(ti)
+        self.trigrams = {tg: frozenset(tis) for tg, tis in trigram_tokens.items()}
+        # docs in the order of ranking, and doc: position in the ranking
+        orders = {
+            'stars': lambda i: (-self.docs[i]['stars'], self.docs[i]['name'],
+                                self.docs[i]['tag']),
+            'recent': lambda i: self.docs[i]['build_date'],
+            'name': lambda i: (self.docs[i]['name'], self.docs[i]['tag'],
+                               self.docs[i]['build_date']),
+        }
+        self.orders = {}
+        self.ranks = {}
+        for sort, key in orders.items():
+            rank = [0] * len(self.docs)
+            ordered = sorted(range(len(self.docs)), key=key,
+                             reverse=(sort == 'recent'))
+            for pos, i in enumerate(ordered):
+                rank[i] = pos
+            self.orders[sort] = ordered
+            self.ranks[sort] = rank
+        self.match = lru_cache(maxsize=4096)(self._match)
+
+    def _prefix_tokens(self, term):
+        i = bisect.bisect_left(self.tokens, term)
+        while i < len(self.tokens) and self.tokens[i].startswith(term):
+            yield i
+            i += 1
+
+    def _substring_tokens(self, term):
+        candidates = None
+        for tg in sorted(trigrams(term), key=lambda tg: len(self.trigrams.get(tg, ()))):
+            tis = self.trigrams.get(tg)
+            if not tis:
+                return
+            candidates = tis if candidates is None else candidates & tis
+        for ti in candidates:
+            if term in self.tokens[ti]:
+                yield ti
+
+    def _match(self, term, prefix):
+        """Return frozenset of docs matching the term"""
+        if prefix or len(term) < 3:
+            tis = self._prefix_tokens(term)
+        else:
+            tis = self._substring_tokens(term)
+        docs = set()
+        for ti in tis:
+            docs.update(self.postings[ti])
+        return frozenset(docs)
+
+    def search(self, query, sort='stars', page=1, per_page=20, prefix=False):
+        """Return a page of documents matching all terms of the query"""
+        if sort not in SORTS:
+            raise ValueError(f"sort must be one of {', '.join(SORTS)}")
+        terms = sorted(set(tokenize(query)))
+        matched = None
+        for term in terms:
+            docs = self.match(term, prefix)
+            matched = docs if matched is None else matched & docs
+            if not matched:
+                break
+        matched = matched or frozenset()
+        n = page * per_page
+        if n * len(self.docs) < len(matched) ** 2:
+            # lots of matches (e.g. short terms): cheaper to walk the ranking
+            # and stop as soon as we have enough
+            top = list(itertools.islice(
+                filter(matched.__contains__, self.orders[sort]), n))
+        else:
+            top = heapq.nsmallest(n, matched, key=self.ranks[sort].__getitem__)
+        return {
+            'count': len(matched),
+            'page': page,
+            'per_page': per_page,
+            'results': [self.docs[i] for i in top[(page - 1) * per_page:]],
+        }
@@ -12,25 +12,41 @@ to go to specific folder within datalad dataset???
 
 import asyncio
 import click
-import json
+import concurrent.futures
+import functools
+import gc
+import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
+import signal
+import time
 from sanic import Sanic
-from sanic.log import logger
+from sanic.log import access_logger, logger
 from sanic import response
+from sanic.response import HTTPResponse, json_dumps
+from sanic.server import HttpProtocol
 from sanic_cors import CORS
 
-# TODO: move from repronim to hub
-GOTO_URL = "https://datasets.datalad.org/?dir=/shub"
-# it is difference since this is direct url without web ui
-TOP_URL = "https://datasets.datalad.org/shub"
+import admission
+import annex
+import cache
+import catalog
+import metrics
+import profiling
+
+GOTO_URL = catalog.GOTO_URL
 
 # TODO: do establish logging for deployed instance
 
 production = "DEV628cc89a6444" not in os.environ
-sem = None
+# to be cancelled upon stop
+background_tasks = []
 basedir = os.getcwd() # environ["HOME"] if production else os.getcwd()
 if production:
-    logdir = '/srv/datasets.datalad.org/shub/logs'
+    logdir = os.environ.get('SHUB_LOGDIR', '/srv/datasets.datalad.org/shub/logs')
     if not os.path.exists(logdir):
         os.makedirs(logdir, mode=0o700, exist_ok=True)
 else:
@@ -83,7 +99,9 @@ LOG_SETTINGS = dict(
             "class": "logging.Formatter",
         },
         "access": {
-            "format": "%(asctime)s - (%(name)s)[%(levelname)s][%(host)s]: "
+            # host is the peer (the proxy, if behind one), client is the
+            # address of the client as told by the proxy (see AccessLogProtocol)
+            "format": "%(asctime)s - (%(name)s)[%(levelname)s][%(host)s][%(client)s]: "
             + "%(request)s %(message)s %(status)d %(byte)d",
             "datefmt": "[%Y-%m-%d %H:%M:%S %z]",
             "class": "logging.Formatter",
@@ -91,10 +109,117 @@ LOG_SETTINGS = dict(
     },
 )
 
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records for the given handlers, dropping them if queue is full
+
+    So logging never blocks the event loop, even if disk is slow.
+    """
+
+    def __init__(self, queue, targets):
+        super().__init__(queue)
+        self.targets = targets
+        self.dropped = 0
+
+    def prepare(self, record):
+        # no need to copy and format here -- target handlers will do it
+        # in the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait((record, self.targets))
+        except queue.Full:
+            self.dropped += 1
+
+
+class RoutingQueueListener(logging.handlers.QueueListener):
+    """Single listener writing records out into handlers they were queued for"""
+
+    def handle(self, item):
+        record, handlers = item
+        record = self.prepare(record)
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+# set by setup_queue_logging
+log_listener = None
+log_queue_handlers = {}  # logger name: DroppingQueueHandler
+
+
+def setup_queue_logging(maxsize):
+    """Replace handlers of sanic loggers with a bounded queue
+
+    A single background thread then does all the writing (and rotation).
+    It needs to be done in every worker process since threads do not
+    survive fork.
+    """
+    global log_listener
+    log_queue = queue.Queue(maxsize)
+    for name in LOG_SETTINGS["loggers"]:
+        log = logging.getLogger(name)
+        handlers = log.handlers[:]
+        if not handlers:
+            continue
+        for h in handlers:
+            log.removeHandler(h)
+        log_queue_handlers[name] = qh = DroppingQueueHandler(log_queue, handlers)
+        log.addHandler(qh)
+    log_listener = RoutingQueueListener(log_queue)
+    log_listener.start()
+
+
+def stop_queue_logging():
+    """Flush all queued records and restore original handlers"""
+    global log_listener
+    if log_listener is None:
+        return
+    log_listener.stop()
+    log_listener = None
+    for name, qh in log_queue_handlers.items():
+        log = logging.getLogger(name)
+        log.removeHandler(qh)
+        for h in qh.targets:
+            log.addHandler(h)
+        if qh.dropped:
+            logger.warning("Dropped %d %s log records since log queue was full",
+                           qh.dropped, name)
+    log_queue_handlers.clear()
+
+
+class AccessLogProtocol(HttpProtocol):
+    """Log also the address of the client into the access log
+
+    Behind the proxy the peer is always the proxy itself, so the client is
+    taken from X-Forwarded-For (trusted only with --proxies-count).
+    """
+
+    def log_response(self, response):
+        if not self.access_log:
+            return
+        request = self.request
+        extra = {
+            "status": getattr(response, "status", 0),
+            "byte": len(response.body) if isinstance(response, HTTPResponse) else -1,
+            "host": "UNKNOWN",
+            "client": "UNKNOWN",
+            "request": "nil",
+        }
+        if request is not None:
+            if request.ip:
+                extra["host"] = f"{request.ip}:{request.port}"
+            extra["client"] = request.remote_addr or request.ip or "UNKNOWN"
+            extra["request"] = f"{request.method} {request.url}"
+        access_logger.info("", extra=extra)
+
+
 if production:
-    app = Sanic("shub-ro", log_config=LOG_SETTINGS)
+    app = Sanic("shub-ro", log_config=LOG_SETTINGS,
+                request_class=admission.AdmissionRequest)
 else:
-    app = Sanic("shub-ro")
+    app = Sanic("shub-ro", request_class=admission.AdmissionRequest)
 CORS(app)
 
 
@@ -114,8 +239,137 @@ def make_header(url):
 
 @app.listener("before_server_start")
 async def init(app, loop):
-    global sem
-    sem = asyncio.Semaphore(100)
+    if app.config.LOG_QUEUE:
+        setup_queue_logging(app.config.LOG_QUEUE)
+    # every worker reloads on its own. To reload them all at once:
+    #   kill -HUP -<process group id>
+    loop.add_signal_handler(
+        signal.SIGHUP,
+        lambda: asyncio.ensure_future(reload_catalog("SIGHUP")))
+    # to profile a worker: kill -USR1 <pid>
+    loop.add_signal_handler(
+        signal.SIGUSR1,
+        lambda: profiling.start(loop, app.config.PROFILE_SECONDS,
+                                app.config.PROFILE_DIR, app.config.PROFILE_FORMAT))
+    if app.config.RELOAD_INTERVAL:
+        background_tasks.append(
+            loop.create_task(watch_catalog(app.config.RELOAD_INTERVAL)))
+    if app.config.METRICS:
+        background_tasks.append(loop.create_task(watch_loop_lag()))
+    if app.config.LOCAL_TREE or app.config.CACHE_DIR:
+        _data_['sendfile_executor'] = concurrent.futures.ThreadPoolExecutor(
+            app.config.IMAGE_THREADS, thread_name_prefix="sendfile")
+        _data_['sending'] = 0
+    if app.config.LOCAL_TREE:
+        _data_['local_tree'] = annex.LocalTree(app.config.LOCAL_TREE)
+    if app.config.CACHE_DIR:
+        _data_['image_cache'] = cache.ImageCache(
+            app.config.CACHE_DIR,
+            app.config.CACHE_SIZE,
+            app.config.CACHE_UPSTREAM,
+            concurrent.futures.ThreadPoolExecutor(
+                app.config.CACHE_FETCHES, thread_name_prefix="fetch"))
+
+
+@app.listener("before_server_stop")
+async def cleanup(app, loop):
+    for task in background_tasks:
+        task.cancel()
+
+
+@app.listener("after_server_stop")
+async def flush_logs(app, loop):
+    stop_queue_logging()
+
+
+@app.middleware("request")
+async def admit(request):
+    """Reject right away if there is too much in flight or client is too eager"""
+    if request.path in ("/admission", "/metrics"):
+        return None
+    # remote_addr is from X-Forwarded-For only if --proxies-count is set
+    rejected = admission.controller.admit(request.remote_addr or request.ip)
+    if rejected is not None:
+        reason, retry_after = rejected
+        if reason == 'rate' and app.config.RATE_DELAY:
+            # does not take any resources while waiting
+            request.done()
+            await asyncio.sleep(app.config.RATE_DELAY)
+        return response.json(
+            {"detail": "Too many requests, retry later."},
+            status=429,
+            headers={**headers, "Retry-After": str(math.ceil(retry_after))}
+        )
+
+
+# route label in metrics per endpoint
+ROUTES = {
+    "main": "redirect",
+    "goto_collection": "collections",
+    "goto_container": "container",
+    "goto_digest": "digest",
+    "search_images": "search",
+    "resolve_containers": "containers",
+    "serve_image": "image",
+    "admission_stats": "admission",
+    "get_metrics": "metrics",
+}
+ROUTES = {f"{app.name}.{k}": v for k, v in ROUTES.items()}
+
+
+@app.middleware("response")
+async def done(request, response):
+    request.done()
+    if app.config.METRICS:
+        # rejected by admission control or not routed at all otherwise
+        route = ROUTES.get(request.endpoint, "none")
+        metrics.observe(route, response.status, time.perf_counter() - request.received)
+    if app.config.SLOW_REQUEST:
+        profiling.log_if_slow(request, response.status, app.config.SLOW_REQUEST)
+
+
+@app.route("admission", methods=["GET"])
+async def admission_stats(request):
+    """Counters of admission control of this worker"""
+    return response.json(
+        {"pid": os.getpid(), **admission.controller.stats()},
+        headers=headers)
+
+
+@app.route("metrics", methods=["GET"])
+async def get_metrics(request):
+    """Metrics of this worker in Prometheus text format"""
+    controller = admission.controller
+    text = metrics.render(
+        gauges=[
+            ("shub_catalog_records", "Number of records in the catalog",
+             {f'kind="{k}"': v for k, v in _data_['catalog'].counts().items()}),
+            ("shub_catalog_load_seconds", "How long the last (re)load of the catalog took",
+             {"": _data_['catalog_load_sec']}),
+            ("shub_catalog_loaded_timestamp_seconds", "When the catalog was (re)loaded",
+             {"": _data_['catalog_loaded']}),
+            ("shub_in_flight", "Requests received but not yet responded to",
+             {"": controller.in_flight}),
+        ],
+        counters=[
+            ("shub_admission_rejected_total", "Requests rejected by admission control",
+             {f'reason="{r}"': controller.counts[f'rejected_{r}']
+              for r in ("in_flight", "rate")}),
+        ])
+    image_cache = _data_.get('image_cache')
+    if image_cache is not None:
+        stats = image_cache.stats()
+        text += metrics.render_extra(
+            gauges=[
+                ("shub_cache_images", "Images in the cache", {"": stats.pop('entries')}),
+                ("shub_cache_bytes", "Size of images in the cache", {"": stats.pop('bytes')}),
+                ("shub_cache_fetching", "Images being fetched", {"": stats.pop('fetching')}),
+            ],
+            counters=[
+                ("shub_cache_events_total", "Cache hits, fetches, evictions etc",
+                 {f'event="{k}"': v for k, v in stats.items()}),
+            ])
+    return response.text(text, content_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.route("/<common:(|about|collections/my|labels)>", methods=["GET"])
@@ -127,21 +381,154 @@ async def main(request, common):
 
 #
 # Since Yarik knows no sanic etc, he would just populate
-# this data structure to be used in the endpoints
+# this data structure to be used in the endpoints.
+# 'catalog' is either catalog.JSONCatalog or catalog.IndexCatalog,
+# and it gets replaced as a whole whenever it is reloaded
 #
 _data_ = {}
 
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+async def reload_catalog(reason):
+    """Load catalog anew in a thread and swap it in
+
+    Requests keep being served from the old catalog while the new one is
+    loaded.  If loading fails, the old catalog stays in use.
+    Note that parsing of a large images.json still holds the GIL for a
+    while, so reloads of a compiled index are much cheaper.
+    """
+    if _data_.get('reloading'):
+        logger.info("Catalog is already being reloaded, ignoring %s", reason)
+        return
+    _data_['reloading'] = True
+    path = app.config.CATALOG_PATH
+    mtime = get_mtime(path)
+    try:
+        logger.info("Reloading catalog from %s due to %s", path, reason)
+        t0 = time.time()
+        new = await asyncio.get_event_loop().run_in_executor(
+            None, functools.partial(catalog.load, path, **app.config.CATALOG_OPTIONS))
+    except Exception as exc:
+        logger.error("Failed to reload catalog from %s, keeping the old one: %s",
+                     path, exc)
+    else:
+        _data_['catalog'] = new
+        _data_['catalog_loaded'] = time.time()
+        _data_['catalog_load_sec'] = _data_['catalog_loaded'] - t0
+        logger.info("Reloaded catalog in %.2f sec", _data_['catalog_load_sec'])
+    finally:
+        # even if failed -- wait for the next change before trying again
+        _data_['catalog_mtime'] = mtime
+        _data_['reloading'] = False
+
+
+async def watch_loop_lag(interval=0.5):
+    """Measure how late the event loop wakes us up"""
+    loop = asyncio.get_event_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        metrics.loop_lag.observe(max(0, loop.time() - t0 - interval))
+
+
+async def watch_catalog(interval):
+    """Reload catalog whenever its file changes"""
+    while True:
+        await asyncio.sleep(interval)
+        mtime = get_mtime(app.config.CATALOG_PATH)
+        if mtime is not None and mtime != _data_['catalog_mtime']:
+            await reload_catalog("change of mtime")
+
+
 headers = {
     "Content-Type": "application/json",
 }
 
+CACHE_CONTROL = catalog.CACHE_CONTROL
+
+
+def etag_matches(request, etag):
+    """Either If-None-Match of the request matches the etag"""
+    if_none_match = request.headers.get("If-None-Match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # weak comparison as prescribed for If-None-Match
+    for t in if_none_match.split(","):
+        t = t.strip()
+        if t.startswith("W/"):
+            t = t[2:]
+        if t == etag:
+            return True
+    return False
+
+
+def parse_tag(tag):
+    """Normalize tag as it comes in the url (e.g. ':tag' or '')"""
+    if tag and tag.startswith(':'):
+        tag = tag[1:]
+    if not tag:
+        tag = 'latest'
+    return tag
+
+
+VERSION_REGEX = re.compile('[0-9a-f]{32}$')
+
+
+def resolve(cat, name, tag):
+    """Return catalog Entry for the tag as it comes in the url, or None
+
+    Besides plain tag (or version) it could also be tag@version, or
+    @version, or @commit (or its unique prefix).
+    """
+    tag = parse_tag(tag)
+    entry = cat.lookup(name, tag)
+    if entry is not None:
+        if tag == 'latest':
+            # unless there is an image tagged latest, we pick the newest one
+            via = 'tag' if b'"tag":"latest"' in entry.body else 'synthesized_latest'
+        else:
+            via = 'version' if VERSION_REGEX.match(tag) else 'tag'
+    elif '@' in tag:
+        tag, _, version = tag.partition('@')
+        if tag:
+            entry = cat.lookup_tag_version(name, tag, version)
+            via = 'tag_version'
+        else:
+            entry = cat.lookup(name, version)
+            via = 'version'
+            if entry is None:
+                entry = cat.lookup_commit(name, version)
+                via = 'commit'
+    if entry is not None and app.config.METRICS:
+        metrics.resolutions[via] += 1
+    return entry
+
+
+def entry_response(request, entry):
+    """Respond with the Entry, or just 304 if client has it already"""
+    cache_headers = {"ETag": entry.etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request, entry.etag):
+        return response.HTTPResponse(status=304, headers=cache_headers)
+    return response.raw(
+        entry.body,
+        headers={**headers, **cache_headers},
+        content_type="application/json")
+
 
 @app.route("collections/<pk:\d+>", methods=["GET", "HEAD"])
-async def goto_container(request, pk):
+async def goto_collection(request, pk):
     """Parse/handle the query
     """
     try:
-        collection = (_data_['collections'].get(str(pk)) or {}).get('full_name')
+        collection = _data_['catalog'].collection(pk)
         if collection:
             return response.redirect(f"{GOTO_URL}/{collection}")
         return response.json(
@@ -157,20 +544,47 @@ async def goto_container(request, pk):
         )
 
 
-@app.route("container/<org:[^/]+>/<repo:[^/:]+><tag:.*>", methods=["GET", "HEAD"])
+@app.route("container/<org:[^/]+>/<repo:[^/:@]+><tag:.*>", methods=["GET", "HEAD"])
 async def goto_container(request, org, repo, tag):
     """Parse/handle the query
     """
+    phases = profiling.Phases(request) if app.config.SLOW_REQUEST else None
     try:
         name = f"{org}/{repo}"
-        collection = _data_['images'].get(name, None)
-        if collection:
-            if tag and tag.startswith(':'):
-                tag = tag[1:]
-            if not tag:
-                tag = 'latest'
-            if tag in collection:
-                return response.json(collection[tag], headers=headers)
+        entry = resolve(_data_['catalog'], name, tag)
+        if phases:
+            phases.mark("lookup")
+        if entry is not None:
+            resp = entry_response(request, entry)
+            if phases:
+                phases.mark("response")
+            return resp
+        return response.json(
+            {"detail": "Not found."},
+            status=404,
+            headers=headers
+        )
+    except Exception as exc:
+        return response.json(
+            {"detail": f"Exception {exc}"},
+            status=500,
+            headers=headers
+        )
+
+
+@app.route("digest/<md5:[0-9a-f]{32}>", methods=["GET", "HEAD"])
+async def goto_digest(request, md5):
+    """Record for the image with md5 (of the newest build if multiple)"""
+    phases = profiling.Phases(request) if app.config.SLOW_REQUEST else None
+    try:
+        entry = _data_['catalog'].lookup_digest(md5)
+        if phases:
+            phases.mark("lookup")
+        if entry is not None:
+            resp = entry_response(request, entry)
+            if phases:
+                phases.mark("response")
+            return resp
         return response.json(
             {"detail": "Not found."},
             status=404,
@@ -184,69 +598,346 @@ async def goto_container(request, org, repo, tag):
         )
 
 
+@app.route("search", methods=["GET"])
+async def search_images(request):
+    """Search among all images records
+
+    Parameters: q (terms to be matched as substrings), mode (substring or
+    prefix), sort (stars, recent or name), page and per_page.
+    """
+    index = _data_['catalog'].search
+    if index is None:
+        return response.json(
+            {"detail": "Search is not available for this catalog."},
+            status=501,
+            headers=headers
+        )
+    try:
+        query = request.args.get("q", "")
+        mode = request.args.get("mode", "substring")
+        page = int(request.args.get("page", 1))
+        per_page = int(request.args.get("per_page", 20))
+        if not query.strip():
+            raise ValueError("q must be provided")
+        if mode not in ("substring", "prefix"):
+            raise ValueError("mode must be substring or prefix")
+        if page < 1 or not (1 <= per_page <= 100) or page * per_page > 10000:
+            raise ValueError("page and per_page (up to 100) are out of range")
+        res = index.search(
+            query,
+            sort=request.args.get("sort", "stars"),
+            page=page,
+            per_page=per_page,
+            prefix=(mode == "prefix"))
+    except ValueError as exc:
+        return response.json(
+            {"detail": str(exc)},
+            status=400,
+            headers=headers
+        )
+    return response.json(res, headers=headers)
+
+
+# md5 of the image in its path within the dataset
+IMAGE_MD5_REGEX = re.compile(r'([0-9a-f]{32})\.[^/]+$')
+
+
+@app.route("image/<path:path>", methods=["GET", "HEAD"])
+async def serve_image(request, path):
+    """Send the image from the local tree or cache, or redirect to TOP_URL
+
+    Images missing from the local tree are fetched into the cache (if
+    enabled).  Also redirects whenever all --image-threads are busy sending.
+    """
+    try:
+        annex.check_path(path)
+    except ValueError:
+        return response.json(
+            {"detail": "Not found."},
+            status=404,
+            headers=headers
+        )
+    tree = _data_.get('local_tree')
+    image_cache = _data_.get('image_cache')
+    if (tree is None and image_cache is None) \
+            or _data_['sending'] >= app.config.IMAGE_THREADS:
+        return response.redirect(f"{catalog.TOP_URL}/{path}")
+    local = tree.get(path) if tree is not None else None
+    fetch = None
+    if local is None and image_cache is not None:
+        res = IMAGE_MD5_REGEX.search(path)
+        md5 = res.group(1) if res else None
+        size = catalog.image_size(_data_['catalog'], md5) if md5 else None
+        if size is not None:
+            cached = image_cache.get(md5, size)
+            etag = f'"{cache.get_key(md5, size)}"'
+            if cached:
+                local = annex.LocalFile(cached, size, etag)
+            elif request.method == "HEAD":
+                # no need to fetch for that
+                local = annex.LocalFile(None, size, etag)
+            else:
+                fetch = image_cache.fetch(md5, size, path)
+                if fetch is not None:
+                    await fetch.started.wait()
+                    if fetch.error is not None:
+                        fetch = None
+                    else:
+                        local = annex.LocalFile(None, size, etag)
+    if local is None:
+        return response.redirect(f"{catalog.TOP_URL}/{path}")
+    file_headers = {
+        "ETag": local.etag,
+        "Cache-Control": CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if etag_matches(request, local.etag):
+        return response.HTTPResponse(status=304, headers=file_headers)
+    status, start, end = 200, 0, local.size - 1
+    byte_range = request.headers.get("Range")
+    # If-Range: range is good only for that version of the file
+    if byte_range and request.headers.get("If-Range", local.etag) == local.etag:
+        try:
+            byte_range = annex.parse_range(byte_range, local.size)
+        except ValueError:
+            return response.HTTPResponse(
+                status=416,
+                headers={**file_headers, "Content-Range": f"bytes */{local.size}"})
+        if byte_range:
+            status, (start, end) = 206, byte_range
+            file_headers["Content-Range"] = f"bytes {start}-{end}/{local.size}"
+    file_headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return response.HTTPResponse(
+            status=status, headers=file_headers,
+            content_type="application/octet-stream")
+
+    async def send(resp):
+        executor = _data_['sendfile_executor']
+        _data_['sending'] += 1
+        try:
+            if fetch is not None:
+                await fetch.send(resp, start, end - start + 1, executor)
+            else:
+                fd = os.open(local.path, os.O_RDONLY)
+                try:
+                    await annex.sendfile(resp, fd, start, end - start + 1, executor)
+                finally:
+                    os.close(fd)
+        finally:
+            _data_['sending'] -= 1
+
+    return response.stream(
+        send, status=status, headers=file_headers,
+        content_type="application/octet-stream", chunked=False)
+
+
+# shub://[host/]org/repo[:tag], shub:// and host being optional
+CONTAINER_REF_REGEX = re.compile(
+    r'^(?:shub://)?(?:[^/]+/)*?(?P<org>[^/]+)/(?P<repo>[^/:@]+)(?P<tag>[^/]*)$')
+# how many containers could be resolved in a single batch request
+MAX_BATCH = 1000
+# larger batches get streamed out
+STREAM_BATCH = 100
+# how much to accumulate before sending out a chunk of the stream
+STREAM_CHUNK = 1 << 16
+
+
+def resolve_batch(refs):
+    """Generate serialized JSON array of resolved records for refs"""
+    cat = _data_['catalog']  # the same one for the entire batch
+    yield b"["
+    for i, ref in enumerate(refs):
+        prefix = b"," if i else b""
+        uri = json_dumps(ref).encode()
+        res = CONTAINER_REF_REGEX.match(ref) if isinstance(ref, str) else None
+        entry = None
+        if res:
+            entry = resolve(
+                cat, f"{res.group('org')}/{res.group('repo')}", res.group('tag'))
+        if entry is not None:
+            yield b'%s{"uri":%s,"status":200,"record":%s}' % (
+                prefix, uri, entry.body)
+        elif res:
+            yield b'%s{"uri":%s,"status":404,"detail":"Not found."}' % (
+                prefix, uri)
+        else:
+            yield b'%s{"uri":%s,"status":400,"detail":"Not a shub:// uri."}' % (
+                prefix, uri)
+    yield b"]"
+
+
+@app.route("containers", methods=["POST"])
+async def resolve_containers(request):
+    """Resolve many containers at once
+
+    Takes JSON list of shub:// uris (or {"containers": [...]}) and returns
+    a list with a record (or a reason for not having one) per uri, in the
+    same order, using the same logic as container/ endpoint.
+    """
+    try:
+        refs = request.json
+    except Exception:
+        refs = None
+    if isinstance(refs, dict):
+        refs = refs.get("containers")
+    if not isinstance(refs, list):
+        return response.json(
+            {"detail": "Expected JSON list of shub:// uris."},
+            status=400,
+            headers=headers
+        )
+    if len(refs) > MAX_BATCH:
+        return response.json(
+            {"detail": f"At most {MAX_BATCH} containers could be resolved at once."},
+            status=413,
+            headers=headers
+        )
+    if len(refs) <= STREAM_BATCH:
+        return response.raw(
+            b"".join(resolve_batch(refs)),
+            headers=headers, content_type="application/json")
+
+    async def stream(resp):
+        buf = []
+        size = 0
+        for piece in resolve_batch(refs):
+            buf.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK:
+                await resp.write(b"".join(buf))
+                buf, size = [], 0
+        await resp.write(b"".join(buf))
+
+    return response.stream(stream, headers=headers, content_type="application/json")
+
+
 @click.command()
 @click.argument("json_path", type=click.Path(exists=True, file_okay=True))
-def main(json_path):
+@click.option("--host", default="0.0.0.0", show_default=True)
+@click.option("--port", type=int, default=5003, show_default=True)
+@click.option("--workers", type=int, default=1, show_default=True,
+              help="Number of worker processes. They all share the catalog "
+                   "loaded once by the parent. With a compiled index it is "
+                   "shared via page cache, otherwise via copy-on-write. With "
+                   "SQLite database each has its own cache of recent names.")
+@click.option("--reload-interval", type=float, default=30, show_default=True,
+              help="How often (seconds) to check if the catalog file changed "
+                   "and should be reloaded. 0 to disable. Reload could also "
+                   "be triggered by SIGHUP.")
+@click.option("--log-queue", type=int, default=0, show_default=True,
+              help="Size of the queue for log records to be written out by "
+                   "a background thread, instead of writing them right "
+                   "within the event loop. Records are dropped (and counted) "
+                   "whenever the queue is full. 0 to disable.")
+@click.option("--search/--no-search", default=True, show_default=True,
+              help="Build search index (only for images.json, not a compiled "
+                   "index or SQLite database) for the search endpoint")
+@click.option("--dump-path", type=click.Path(exists=True, file_okay=False),
+              help="Database dump (e.g. _data_/dump/backup-2021) to enrich "
+                   "search with labels and stars from")
+@click.option("--max-in-flight", type=int, default=1000, show_default=True,
+              help="Respond with 429 to new requests while that many are "
+                   "already received but not responded to by the worker. "
+                   "0 to disable.")
+@click.option("--rate-limit", type=float, default=0, show_default=True,
+              help="Requests per second allowed per client. 0 to disable.")
+@click.option("--rate-burst", type=int, default=0,
+              help="How many requests a client could make at once. "
+                   "Default: --rate-limit")
+@click.option("--rate-delay", type=float, default=0, show_default=True,
+              help="Hold 429 responses to clients over --rate-limit for "
+                   "that many seconds, so they cannot hog the worker even "
+                   "if they ignore Retry-After")
+@click.option("--proxies-count", type=int, default=0, show_default=True,
+              help="Number of reverse proxies in front, to identify clients "
+                   "by X-Forwarded-For instead of the peer address")
+@click.option("--local-tree", type=click.Path(exists=True, file_okay=False),
+              help="Local clone of the dataset to serve images (present in it) "
+                   "from, at image/ endpoint")
+@click.option("--image-url",
+              help="Public url of the image/ endpoint, e.g. "
+                   "https://singularity-hub.org/api/image, for records to "
+                   "point to it instead of " + catalog.TOP_URL + ". For a "
+                   "compiled index, use catalog.py compile --top-url instead")
+@click.option("--image-threads", type=int, default=16, show_default=True,
+              help="How many images could be sent at once, per worker. "
+                   "Others get redirected")
+@click.option("--cache-dir", type=click.Path(file_okay=False),
+              help="Directory to cache images (missing from --local-tree) "
+                   "fetched from --cache-upstream in. Needs single worker")
+@click.option("--cache-size", type=float, default=100, show_default=True,
+              help="Maximal total size (GB) of cached images")
+@click.option("--cache-upstream", default=catalog.TOP_URL, show_default=True,
+              help="Base url to fetch images into the cache from")
+@click.option("--cache-fetches", type=int, default=4, show_default=True,
+              help="How many images could be fetched at once")
+@click.option("--metrics/--no-metrics", "record_metrics", default=True, show_default=True,
+              help="Record metrics to be served at /metrics")
+@click.option("--slow-request", type=float, default=0, show_default=True,
+              help="Log requests which took longer than that many seconds, with "
+                   "how long each phase of container/ and digest/ took. 0 "
+                   "disables timing of phases altogether.")
+@click.option("--profile-seconds", type=float, default=30, show_default=True,
+              help="How long to profile a worker for once it gets SIGUSR1")
+@click.option("--profile-format", type=click.Choice(profiling.FORMATS),
+              default="collapsed", show_default=True,
+              help="collapsed stacks sampled every "
+                   f"{profiling.SAMPLE_INTERVAL * 1000:g} ms, or pstats of "
+                   "cProfile (which slows the worker down while profiling)")
+@click.option("--profile-dir", type=click.Path(exists=True, file_okay=False),
+              help="Where to write profiles into. Default: the log directory")
+def main(json_path, host, port, workers, reload_interval, log_queue,
+         search, dump_path, max_in_flight, rate_limit, rate_burst, rate_delay,
+         proxies_count, local_tree, image_url, image_threads, cache_dir,
+         cache_size, cache_upstream, cache_fetches, record_metrics,
+         slow_request, profile_seconds, profile_format, profile_dir):
+    """Serve images.json (or its index compiled with catalog.py compile, or
+    SQLite database produced by process_dump.py sqlite)"""
     logger.info("Loading")
-    with open(json_path) as f:
-        raw = json.load(f)
-
-    assert set(raw) == {'images', 'collections'}
-    _data_['collections'] = raw['collections']
-
-    # prepare target complete records to return
-    # Decided to keep this logic here so we could adjust
-    # matching without needing to regenerate input file
-    logger.info("Preparing final images records")
-    # to ease comparison etc
-    fields_order = 'id', 'name', 'branch', 'commit', 'tag', 'version', 'size_mb', 'image', 'build_date'
-    recs = {}
-    n_latest = 0
-    for name, files in raw['images'].items():
-        recs[name] = res = {}  # tag: { ready image record }
-        latest = None
-        for f in files:
-            rec = f.copy()
-            rec['name'] = name
-            rec['image'] = f"{TOP_URL}/{rec.pop('file')}"
-            # order (and "pop") the fields to match the one we observe with
-            # stock singularity hub which we just eagerly got but not needed
-            rec = {
-                _: rec[_] for _ in fields_order if _ in rec
-            }
-            # paranoia
-            if latest is not None and latest['build_date'] == rec['build_date']:
-                raise RuntimeError(f"Found the one with the same date for {rec}")
-            if latest is None or latest['build_date'] < rec['build_date']:
-                latest = rec
-            # what lookups are "supported
-            for id_field in 'tag', 'version':
-                id_ = f[id_field]
-                if id_ in res:
-                    # replace only if build_date is after a known one
-                    # due to use of iso I think string comparison should be
-                    # good enough
-                    if res[id_]['build_date'] > rec['build_date']:
-                        continue  # we do not replace
-                res[id_] = rec
-        if 'latest' not in res:
-            n_latest += 1
-            if not production:
-                print(f"{n_latest:02d}/{len(raw['images'])} {name}: "
-                      f"adding detected 'latest' among {len(files)} records: "
-                      f"tag {latest['tag']} from {latest['build_date']}")
-            res['latest'] = latest
-
-    # strip away all build_date's
-    for _, tags in recs.items():
-        for _, r in tags.items():
-            # could be already gone since we bind the same record across
-            # multiple tags
-            r.pop('build_date', None)
-
-    _data_['images'] = recs
-    logger.info("Starting backend")
-    app.run(host="0.0.0.0", port=5003)
+    app.config.CATALOG_PATH = json_path
+    app.config.RELOAD_INTERVAL = reload_interval
+    app.config.LOG_QUEUE = log_queue
+    app.config.CATALOG_OPTIONS = dict(search=search, dump_path=dump_path)
+    if image_url:
+        if catalog.is_index(json_path):
+            raise click.UsageError(
+                "Image urls of a compiled index could only be changed by "
+                "compiling it with --top-url")
+        app.config.CATALOG_OPTIONS['top_url'] = image_url.rstrip('/')
+    app.config.LOCAL_TREE = local_tree
+    app.config.IMAGE_THREADS = image_threads
+    if cache_dir and workers > 1:
+        # they would not know about each other's fetches and cached images
+        raise click.UsageError("--cache-dir could be used only with a single worker")
+    app.config.CACHE_DIR = cache_dir
+    app.config.CACHE_SIZE = int(cache_size * 2**30)
+    app.config.CACHE_UPSTREAM = cache_upstream
+    app.config.CACHE_FETCHES = cache_fetches
+    if proxies_count:
+        app.config.PROXIES_COUNT = proxies_count
+    admission.setup(max_in_flight, rate_limit, rate_burst)
+    app.config.RATE_DELAY = rate_delay
+    app.config.METRICS = record_metrics
+    app.config.SLOW_REQUEST = slow_request
+    app.config.PROFILE_SECONDS = profile_seconds
+    app.config.PROFILE_FORMAT = profile_format
+    app.config.PROFILE_DIR = profile_dir or logdir
+    _data_['catalog_mtime'] = get_mtime(json_path)
+    t0 = time.time()
+    _data_['catalog'] = catalog.load(
+        json_path, verbose=not production, **app.config.CATALOG_OPTIONS)
+    _data_['catalog_loaded'] = time.time()
+    _data_['catalog_load_sec'] = _data_['catalog_loaded'] - t0
+    # Move everything loaded so far out of the reach of cyclic GC, so its
+    # passes in the workers do not touch (and thus copy) pages with the catalog
+    gc.collect()
+    gc.freeze()
+    # workers handle it. Parent must not die (default action)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    logger.info("Starting backend with %d worker(s)", workers)
+    app.run(host=host, port=port, workers=workers, protocol=AccessLogProtocol)
 
 
 if __name__ == "__main__":
@@ -3,5 +3,5 @@
 set -eu
 umask 077
 cd $(dirname $0) && cd ..
-singularity run --no-home -e -B /srv/datasets.datalad.org/shub/logs -B $PWD _service_/service.sif _service_/serve.py _data_/images.json &
+singularity run --no-home -e -B /srv/datasets.datalad.org/shub/logs -B $PWD _service_/service.sif _service_/serve.py _data_/images.json --log-queue 10000 --proxies-count 1 &
 disown
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Pull statistics from access logs of the shub:// service (_service_/serve.py)
+
+Streams all access.log* files (rotated ones could be gzip'ed) under the logs
+directory, in parallel across files, and aggregates
+
+- hits.csv:  day, name, tag, status, hits
+- hosts.csv: week, name, tag, hosts  (number of distinct client hosts)
+
+for container/ requests.  Results per log file are saved under the state
+directory, so re-runs only read new (or changed, e.g. current access.log)
+files.  Client hosts are taken from the [client] field (X-Forwarded-For as
+passed by the proxy, or the peer if there was none).  Older logs have only
+the [host] of the peer, which behind the proxy is always the proxy itself.
+Either way loopback addresses are the proxy or local checks, so they are not
+counted towards hosts.  E.g.
+
+    _tools_/access_stats.py /srv/datasets.datalad.org/shub/logs /tmp/shub-stats
+
+"""
+
+import csv
+import datetime
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import os.path as op
+import re
+from collections import Counter, defaultdict
+from pathlib import Path
+from urllib.parse import unquote, urlsplit
+
+import click
+
+# as produced by "access" formatter of LOG_SETTINGS in serve.py:
+# [2021-04-26 17:58:27 +0000] - (sanic.access)[INFO][127.0.0.1:58396][1.2.3.4]: GET http://.../container/org/repo:tag  200 310
+# or, before [client] was added, without it
+ACCESS_REGEX = re.compile(
+    r'^\[(?P<date>\d{4}-\d\d-\d\d) [^\]]*\] - \(sanic\.access\)\[\w+\]'
+    r'\[(?P<host>[^\]]*)\](?:\[(?P<client>[^\]]*)\])?: (?P<method>\S+) (?P<url>\S+) .*?'
+    r'(?P<status>\d{3}) (?P<bytes>-?\d+)$'
+)
+CONTAINER_REGEX = re.compile(r'/container/(?P<name>[^/]+/[^/:@]+)(?P<tag>.*)$')
+
+# bump whenever the format of stored per file results changes
+STATE_VERSION = 3
+# addresses which are the proxy or local checks, not clients
+LOOPBACK = ('127.0.0.1', '::1', '[::1]')
+
+
+def get_container_tag(url):
+    """Return (name, tag) for container/ url, or None"""
+    res = CONTAINER_REGEX.search(unquote(urlsplit(url).path))
+    if not res:
+        return None
+    tag = res.group('tag')
+    if tag.startswith(':'):
+        tag = tag[1:]
+    return res.group('name'), tag or 'latest'
+
+
+def get_week(day):
+    year, week, _ = datetime.date.fromisoformat(day).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def get_client(res):
+    """Return address of the client of the matched line, or None if unknown"""
+    client = res.group('client')
+    if client is None:
+        # just the peer -- strip the port
+        client = res.group('host').rsplit(':', 1)[0]
+    if not client or client == 'UNKNOWN' or client in LOOPBACK:
+        return None
+    return client
+
+
+def hash_host(host):
+    """Anonymize the client host"""
+    return hashlib.blake2b(host.encode(), digest_size=8).hexdigest()
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def parse_log(path):
+    """Aggregate a single log file, reading it line by line"""
+    hits = Counter()          # (day, name, tag, status): hits
+    hosts = defaultdict(set)  # (week, name, tag): {host}
+    weeks = {}                # day: week
+    n_lines = n_skipped = 0
+    with open_log(path) as f:
+        for line in f:
+            n_lines += 1
+            res = ACCESS_REGEX.match(line.rstrip('\n'))
+            if not res:
+                n_skipped += 1
+                continue
+            name_tag = get_container_tag(res.group('url'))
+            if not name_tag:
+                continue
+            day = res.group('date')
+            hits[(day, *name_tag, int(res.group('status')))] += 1
+            week = weeks.get(day)
+            if week is None:
+                week = weeks[day] = get_week(day)
+            client = get_client(res)
+            if client is not None:
+                hosts[(week, *name_tag)].add(hash_host(client))
+    return {
+        'lines': n_lines,
+        'skipped': n_skipped,
+        'hits': [[*k, v] for k, v in hits.items()],
+        'hosts': [[*k, sorted(v)] for k, v in hosts.items()],
+    }
+
+
+def get_stamp(path):
+    st = os.stat(path)
+    return {'version': STATE_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def _process(args):
+    path, state_file = args
+    stamp = get_stamp(path)
+    res = parse_log(path)
+    res.update(stamp)
+    tmp = f"{state_file}.tmp"
+    with gzip.open(tmp, 'wt') as f:
+        json.dump(res, f)
+    os.replace(tmp, state_file)
+    return path, res['lines']
+
+
+def load_state(state_file, path):
+    """Return saved results for the log file if it did not change since"""
+    try:
+        with gzip.open(state_file, 'rt') as f:
+            res = json.load(f)
+    except (OSError, ValueError):
+        return None
+    stamp = get_stamp(path)
+    if any(res.get(k) != v for k, v in stamp.items()):
+        return None
+    return res
+
+
+@click.command()
+@click.argument("logs_path", type=click.Path(exists=True, file_okay=False))
+@click.argument("output_path", type=click.Path(file_okay=False))
+@click.option("--state", "state_path", type=click.Path(file_okay=False),
+              help="Where to keep per log file results. "
+                   "Default: .state/ under OUTPUT_PATH")
+@click.option("-j", "--jobs", type=int, default=os.cpu_count(), show_default=True)
+@click.option("--top", type=int, default=20, show_default=True,
+              help="How many most pulled containers to print")
+def main(logs_path, output_path, state_path, jobs, top):
+    output_path = Path(output_path)
+    state_path = Path(state_path or output_path / '.state')
+    state_path.mkdir(parents=True, exist_ok=True)
+
+    logs = sorted(str(p) for p in Path(logs_path).glob('access.log*'))
+    state_files = {p: str(state_path / (op.basename(p) + '.json.gz')) for p in logs}
+    todo = [p for p in logs if load_state(state_files[p], p) is None]
+    print(f"INFO: {len(logs)} log files, {len(todo)} to (re)process")
+    if todo:
+        with multiprocessing.Pool(jobs) as pool:
+            for path, n_lines in pool.imap_unordered(
+                    _process, [(p, state_files[p]) for p in todo]):
+                print(f"INFO: processed {path}: {n_lines} lines")
+    # remove state for logs which are gone
+    known = set(op.basename(f) for f in state_files.values())
+    for f in state_path.glob('*.json.gz'):
+        if f.name not in known:
+            f.unlink()
+
+    hits = Counter()
+    hosts = defaultdict(set)
+    n_skipped = 0
+    for p in logs:
+        res = load_state(state_files[p], p)
+        if res is None:
+            # must have changed while we were processing it -- no biggie,
+            # whatever we saved is still good
+            with gzip.open(state_files[p], 'rt') as f:
+                res = json.load(f)
+        n_skipped += res['skipped']
+        for *k, v in res['hits']:
+            hits[tuple(k)] += v
+        for *k, v in res['hosts']:
+            hosts[tuple(k)].update(v)
+    if n_skipped:
+        print(f"WARNING: {n_skipped} lines did not match the access log format")
+
+    output_path.mkdir(parents=True, exist_ok=True)
+    with open(output_path / 'hits.csv', 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['day', 'name', 'tag', 'status', 'hits'])
+        for k in sorted(hits):
+            w.writerow([*k, hits[k]])
+    with open(output_path / 'hosts.csv', 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['week', 'name', 'tag', 'hosts'])
+        for k in sorted(hosts):
+            w.writerow([*k, len(hosts[k])])
+
+    per_container = Counter()
+    for (_, name, tag, status), v in hits.items():
+        if status == 200:
+            per_container[f"{name}:{tag}"] += v
+    print(f"INFO: {sum(hits.values())} container/ requests, "
+          f"{len(per_container)} containers pulled. Top {top}:")
+    for c, n in per_container.most_common(top):
+        print(f"  {n:8d} {c}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Hashing of many files with a state DB to resume from
+
+Shared by verify_checksums.py and inject_legacy.py: files (images of up to
+many GBs) are hashed on a pool of processes, and results are recorded into
+a state DB (sqlite) as they come, so an interrupted run resumes without
+rehashing what was hashed already.
+"""
+
+import hashlib
+import os
+import os.path as op
+import sqlite3
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import click
+import tqdm
+
+# commit to the state DB at least that often (seconds)
+COMMIT_EVERY = 10
+
+
+def default_state_path(top, name):
+    """State DB within git dir of TOP, or in the user cache if it is not a git repo
+
+    git dir is not necessarily TOP/.git, e.g. for a worktree or a submodule.
+    """
+    try:
+        git_dir = subprocess.run(
+            ['git', '-C', top, 'rev-parse', '--absolute-git-dir'],
+            check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        git_dir = None
+    if git_dir:
+        return op.join(git_dir, f'{name}.db')
+    cache = op.join(os.environ.get('XDG_CACHE_HOME') or op.expanduser('~/.cache'), 'shub')
+    os.makedirs(cache, exist_ok=True)
+    key = hashlib.md5(op.abspath(top).encode()).hexdigest()[:8]
+    return op.join(cache, f'{name}-{key}.db')
+
+
+class StateDB:
+    """sqlite DB of results of previous runs, committed every COMMIT_EVERY seconds"""
+
+    def __init__(self, path, schema):
+        try:
+            self.db = sqlite3.connect(path)
+            self.db.execute(schema)
+        except sqlite3.Error as exc:
+            raise click.ClickException(
+                f"Cannot use {path} as the state DB ({exc}), point --state elsewhere")
+        self.last_commit = time.time()
+
+    def insert(self, sql, values):
+        self.db.execute(sql, values)
+        if time.time() - self.last_commit > COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.last_commit = time.time()
+
+
+def hash_all(func, top, todo, jobs, state):
+    """Run func(top, relpath, stat) for (relpath, stat) of todo on a pool of processes
+
+    Yields (relpath, stat, result, error) as they are done, where error is
+    the OSError func raised (and then result is None).  Those which failed
+    so should not be recorded into the state, to be retried next time.  The
+    state is committed once all are done, or if interrupted.
+    """
+    total = sum(st.st_size for _, st in todo)
+    todo = todo[::-1]
+    with ProcessPoolExecutor(jobs) as executor, \
+            tqdm.tqdm(total=total, unit="B", unit_scale=True, desc="hashing") as progress:
+        pending = {}
+        try:
+            while todo or pending:
+                # could be GBs each, so do not queue too many
+                while todo and len(pending) < jobs * 2:
+                    relpath, st = todo.pop()
+                    pending[executor.submit(func, top, relpath, st)] = (relpath, st)
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    relpath, st = pending.pop(fut)
+                    try:
+                        result = fut.result()
+                    except OSError as exc:
+                        yield relpath, st, None, exc
+                        continue
+                    yield relpath, st, result, None
+                    progress.update(st.st_size)
+        finally:
+            state.commit()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Inject images of singularityhub-legacy into the dataset
+
+As inject_legacy.sh did, every singularityhub-legacy/github.com/<org>/<repo>/<commit>
+directory with <md5>.img.gz (md5 of gunzip'ed content) is moved to
+<org>/<repo>/<commit>/<md5>, once md5 is verified.  But
+
+- images are gunzip'ed and hashed in a streaming fashion on a pool of
+  processes, with large buffers,
+- hashes are recorded in a state DB (sqlite) as they come, so an
+  interrupted run resumes without rehashing what was hashed already,
+- all moves are planned first and then applied in one batch, and only if
+  no image failed verification (unless --partial),
+- every problem (mismatch, absent image, existing target, corrupted gzip)
+  is reported as a JSON line instead of aborting on the first one, e.g.
+
+    _tools_/inject_legacy.py run -j 8 --report /tmp/legacy-problems.jsonl .
+
+`bench` measures MB/s of hashing on synthetic gz files for a number of jobs.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import tqdm
+
+from hashpool import StateDB, default_state_path, hash_all
+
+LEGACY = op.join("singularityhub-legacy", "github.com")
+SUFFIX = ".img.gz"
+# bytes to read at once
+BUFFER_SIZE = 1 << 24
+# max bytes to decompress at once, images compress well
+OUT_SIZE = 1 << 26
+# for zlib to expect gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+GZIP_MAGIC = b'\x1f\x8b'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    md5 TEXT,          -- of gunzip'ed content, NULL if could not gunzip
+    uncompressed INTEGER,
+    error TEXT,
+    hashed REAL
+)
+"""
+
+
+def gunzip_md5(path):
+    """Return (md5, size) of the gunzip'ed content of the file
+
+    As zcat, concatenated gzip members are all decompressed, and trailing
+    garbage after the last one is ignored.
+    """
+    md5 = hashlib.md5()
+    size = 0
+    d = zlib.decompressobj(GZIP_WBITS)
+    in_member = False
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            data = view[:n]
+            while data:
+                in_member = True
+                out = d.decompress(data, OUT_SIZE)
+                md5.update(out)
+                size += len(out)
+                if d.eof:
+                    data = d.unused_data
+                    in_member = False
+                    if data and not data.startswith(GZIP_MAGIC[:len(data)]):
+                        return md5.hexdigest(), size
+                    d = zlib.decompressobj(GZIP_WBITS)
+                else:
+                    data = d.unconsumed_tail
+    if in_member:
+        raise zlib.error("truncated gzip file")
+    return md5.hexdigest(), size
+
+
+def hash_image(path):
+    """Return (md5, uncompressed size, error) for the image"""
+    try:
+        md5, size = gunzip_md5(path)
+    except (zlib.error, EOFError) as exc:
+        return None, None, str(exc)
+    return md5, size, None
+
+
+def hash_legacy(top, relpath, st):
+    """hash_image of relpath under top, as hash_all calls it"""
+    return hash_image(op.join(top, relpath))
+
+
+def find_legacy(top):
+    """Yield (relpath of the directory, [*.img.gz in it]) for all legacy directories"""
+    def subdirs(path):
+        try:
+            return sorted(e.name for e in os.scandir(path) if e.is_dir())
+        except FileNotFoundError:
+            return []
+
+    for org in subdirs(op.join(top, LEGACY)):
+        for repo in subdirs(op.join(top, LEGACY, org)):
+            for commit in subdirs(op.join(top, LEGACY, org, repo)):
+                d = op.join(LEGACY, org, repo, commit)
+                yield d, sorted(f for f in os.listdir(op.join(top, d))
+                                if f.endswith(SUFFIX))
+
+
+class State(StateDB):
+    """DB of hashes of images from previous runs"""
+
+    def __init__(self, path):
+        super().__init__(path, SCHEMA)
+
+    def get(self, relpath, st):
+        """Return (md5, error) if hashed already and did not change since"""
+        row = self.db.execute(
+            "SELECT md5, error FROM hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (relpath, st.st_size, st.st_mtime_ns)).fetchone()
+        return row
+
+    def record(self, relpath, st, md5, uncompressed, error):
+        self.insert(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (relpath, st.st_size, st.st_mtime_ns, md5, uncompressed, error,
+             time.time()))
+
+
+def plan(top, jobs, state):
+    """Return ([(source dir, target dir)], [problems]) for all legacy directories"""
+    problems = []
+    images = {}    # relpath of image: (source dir, target dir, expected md5)
+    todo = []      # (relpath of image, stat) to hash
+    hashed = {}    # relpath of image: (md5, error)
+    for d, imgs in find_legacy(top):
+        if len(imgs) != 1:
+            problems.append({'path': d, 'problem': 'absent' if not imgs else 'several',
+                             'images': imgs})
+            continue
+        org, repo, commit = d.split(os.sep)[-3:]
+        md5 = imgs[0][:-len(SUFFIX)]
+        target = op.join(org, repo, commit, md5)
+        if op.lexists(op.join(top, target)):
+            problems.append({'path': d, 'problem': 'exists', 'target': target})
+            continue
+        relpath = op.join(d, imgs[0])
+        images[relpath] = (d, target, md5)
+        st = os.stat(op.join(top, relpath))
+        prev = state.get(relpath, st)
+        if prev:
+            hashed[relpath] = prev
+        else:
+            todo.append((relpath, st))
+
+    print(f"INFO: {len(images)} legacy images, {len(hashed)} hashed already, "
+          f"{len(todo)} ({sum(st.st_size for _, st in todo) / 2**30:.1f} GB) to hash, "
+          f"{len(problems)} directories with problems", file=sys.stderr)
+    t0 = time.time()
+    for relpath, st, result, exc in hash_all(hash_legacy, top, todo, jobs, state):
+        if exc:
+            # not recorded, so would be retried next time
+            md5, error = None, str(exc)
+        else:
+            md5, uncompressed, error = result
+            state.record(relpath, st, md5, uncompressed, error)
+        hashed[relpath] = (md5, error)
+        if error or md5 != images[relpath][2]:
+            tqdm.tqdm.write(f"ERROR: {relpath}: {error or md5}", file=sys.stderr)
+    if todo:
+        dt = time.time() - t0
+        total = sum(st.st_size for _, st in todo)
+        print(f"INFO: hashed {total / 2**20:.0f} MB in {dt:.1f} sec "
+              f"({total / 2**20 / max(dt, 1e-6):.0f} MB/sec)", file=sys.stderr)
+
+    moves = []
+    for relpath, (d, target, expected) in sorted(images.items()):
+        md5, error = hashed[relpath]
+        if error:
+            problems.append({'path': relpath, 'problem': 'error', 'error': error})
+        elif md5 != expected:
+            problems.append({'path': relpath, 'problem': 'md5', 'expected': expected,
+                             'computed': md5})
+        else:
+            moves.append((d, target))
+    return moves, problems
+
+
+def apply_moves(top, moves):
+    for source, target in moves:
+        os.makedirs(op.join(top, op.dirname(target)), exist_ok=True)
+        os.rename(op.join(top, source), op.join(top, target))
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.argument("top", type=click.Path(exists=True, file_okay=False), default=".")
+@click.option("-j", "--jobs", type=int, default=os.cpu_count(), show_default=True,
+              help="Number of processes to hash in")
+@click.option("--state", type=click.Path(dir_okay=False),
+              help="State DB to resume from and to record into. "
+                   "[default: in git dir of TOP, or in ~/.cache/shub]")
+@click.option("--report", type=click.File("w"), default="-", show_default=True,
+              help="Where to write JSON lines with problems")
+@click.option("--partial", is_flag=True,
+              help="Move those verified even if others had problems")
+@click.option("--dry-run", is_flag=True, help="Only verify and report what would be moved")
+def run(top, jobs, state, report, partial, dry_run):
+    """Verify and move legacy images under TOP into <org>/<repo>/<commit>/<md5>"""
+    state = State(state or default_state_path(top, 'inject_legacy'))
+    moves, problems = plan(top, jobs, state)
+    for problem in problems:
+        report.write(json.dumps(problem) + "\n")
+    print(f"INFO: {len(moves)} directories to move, {len(problems)} problems",
+          file=sys.stderr)
+    if dry_run:
+        for source, target in moves:
+            print(f"{source} -> {target}")
+    elif problems and not partial:
+        print("INFO: not moving anything, rerun with --partial to move verified ones",
+              file=sys.stderr)
+    else:
+        apply_moves(top, moves)
+        print(f"INFO: moved {len(moves)} directories", file=sys.stderr)
+    if problems:
+        sys.exit(1)
+
+
+def make_image(path, size):
+    """Write gzip'ed file of size bytes, compressible as images are. Return its md5"""
+    md5 = hashlib.md5()
+    block = 1 << 20
+    with gzip.open(path, 'wb', compresslevel=6) as f:
+        for i in range(0, size, block):
+            # half random, half zeros: images are ~2x compressible
+            data = (os.urandom(block // 2) + bytes(block // 2))[:size - i]
+            md5.update(data)
+            f.write(data)
+    return md5.hexdigest()
+
+
+@main.command()
+@click.option("-n", "--images", type=int, default=8, show_default=True)
+@click.option("--size-mb", type=int, default=64, show_default=True,
+              help="Uncompressed size of every image")
+@click.option("-j", "--jobs", multiple=True, type=int,
+              help="Number of processes to try [default: 1, 2, 4, ... up to cores]")
+@click.option("--zcat", is_flag=True, help="Also time zcat | md5sum as inject_legacy.sh did")
+def bench(images, size_mb, jobs, zcat):
+    """Measure MB/s of hashing synthetic gz images"""
+    jobs = jobs or sorted({min(2 ** i, os.cpu_count()) for i in range(8)
+                           if 2 ** i <= 2 * os.cpu_count()})
+    tmp = tempfile.mkdtemp(prefix="inject_legacy-bench-")
+    try:
+        paths = []
+        for i in range(images):
+            path = op.join(tmp, f"{i}{SUFFIX}")
+            md5 = make_image(path, size_mb << 20)
+            paths.append((path, md5))
+        compressed = sum(op.getsize(p) for p, _ in paths)
+        uncompressed = images * size_mb
+        print(f"INFO: {images} images of {size_mb} MB, {compressed / 2**20:.0f} MB compressed")
+
+        def report(what, dt):
+            print(f"{what:>16}: {dt:6.2f} sec, {compressed / 2**20 / dt:6.0f} MB/s compressed, "
+                  f"{uncompressed / dt:6.0f} MB/s uncompressed")
+
+        if zcat:
+            t0 = time.time()
+            for path, md5 in paths:
+                out = subprocess.run(f"zcat {path} | md5sum", shell=True, check=True,
+                                     capture_output=True, text=True).stdout
+                assert out.split()[0] == md5
+            report("zcat | md5sum", time.time() - t0)
+        for n in jobs:
+            t0 = time.time()
+            with ProcessPoolExecutor(n) as executor:
+                results = list(executor.map(hash_image, [p for p, _ in paths]))
+            assert [r[0] for r in results] == [md5 for _, md5 in paths]
+            report(f"{n} jobs", time.time() - t0)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,16 +30,24 @@ __author__ = 'yoh'
 __license__ = 'MIT'
 
 import base64
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import click
+import hashlib
 import itertools
+import os
 import os.path as op
 import re
+import subprocess
+import time
 import tqdm
 import json
 from pathlib import Path
 from urllib.parse import urlsplit, unquote
 
+# max number of paths to pass to a single git call
+GIT_CHUNK = 1000
+
 
 def get_sif_files(fields):
     return [
@@ -73,112 +81,336 @@ def from_annex_key(key):
     assert res
     return res.groupdict()
 
+
+def iter_dump(path, chunk_size=1 << 20, with_text=False):
+    """Yield records of a Django dump (JSON array of objects) one by one
+
+    The same as iterating over json.load(f) but without ever having the
+    whole dump (or all the records) in memory.  With with_text, yield
+    (record, its text in the dump) instead.
+    """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buf, pos, eof = '', 0, False
+        started = False
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(buf):
+                if eof:
+                    raise ValueError(f"{path} ended before the end of the array")
+                buf, pos = f.read(chunk_size), 0
+                eof = not buf
+                continue
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f"{path} does not contain a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            if buf[pos] == ',':
+                pos += 1
+                continue
+            try:
+                rec, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # record is not yet all in the buffer
+                chunk = f.read(max(chunk_size, len(buf) - pos))
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            # it must be followed by , or ] -- otherwise it could be just the
+            # beginning of a number cut by the end of the buffer
+            nxt = end
+            while nxt < len(buf) and buf[nxt] in ' \t\r\n':
+                nxt += 1
+            if nxt == len(buf) or buf[nxt] not in ',]':
+                if eof:
+                    raise ValueError(f"{path} has no , or ] after record at {end}")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            yield (rec, buf[pos:end]) if with_text else rec
+            pos = nxt
+
+
+class LinksCache:
+    """Symlink targets already read from monolith, kept across runs
+
+    It is a file of "relpath<TAB>target" lines, appended to as we go, so
+    even an interrupted run is not wasted.  The first line records the
+    version (git HEAD) of monolith the targets were read from, and the
+    cache is discarded if monolith is at another one, e.g. some images
+    got re-annexed since.
+    """
+
+    def __init__(self, path, version):
+        self.links = {}
+        header = f"HEAD\t{version}\n"
+        if op.exists(path):
+            with open(path) as f:
+                if f.readline() == header:
+                    for line in f:
+                        # the last line might be incomplete if we got killed
+                        if line.endswith('\n') and '\t' in line:
+                            relpath, target = line[:-1].split('\t', 1)
+                            self.links[relpath] = target
+                else:
+                    print(f"INFO: {path} is not for {version} of monolith, discarding it")
+        self._f = open(path, 'a' if self.links else 'w')
+        if not self.links:
+            self._f.write(header)
+
+    def get(self, relpath):
+        return self.links.get(relpath)
+
+    def add(self, relpath, target):
+        self.links[relpath] = target
+        self._f.write(f"{relpath}\t{target}\n")
+
+    def close(self):
+        self._f.close()
+
+
+def get_monolith_version(monolith_path):
+    """Return git HEAD of monolith, or None if it is not a git repository"""
+    try:
+        return subprocess.run(
+            ['git', '-C', str(monolith_path), 'rev-parse', 'HEAD'],
+            check=True, capture_output=True, text=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_link(path):
+    """Return target of the symlink, or None if path is not a symlink"""
+    try:
+        return os.readlink(path)
+    except OSError:
+        return None
+
+
+def iter_links(items, monolith_path, jobs, cache=None, readlink=read_link):
+    """Yield (item, target) for items ending with a relpath of a symlink in monolith
+
+    Links are read on a pool of jobs threads, at most jobs * 16 ahead of
+    what was yielded, and in the same order as items.  Those in the cache
+    are not read at all.
+    """
+    t0 = time.time()
+    counts = Counter()
+    pending = deque()
+    with ThreadPoolExecutor(jobs) as executor:
+
+        def pop():
+            item, target = pending.popleft()
+            if isinstance(target, Future):
+                target = target.result()
+                if cache is not None and target is not None:
+                    cache.add(item[-1], target)
+            return item, target
+
+        for item in items:
+            relpath = item[-1]
+            target = cache.get(relpath) if cache is not None else None
+            if target is not None:
+                counts['cached'] += 1
+            else:
+                counts['read'] += 1
+                target = executor.submit(readlink, str(monolith_path / relpath))
+            pending.append((item, target))
+            if len(pending) >= jobs * 16:
+                yield pop()
+        while pending:
+            yield pop()
+    dt = time.time() - t0
+    print(f"INFO: read {counts['read']} symlinks (and {counts['cached']} cached) "
+          f"with {jobs} threads in {dt:.1f} sec ({counts['read'] / max(dt, 1e-6):.0f}/sec)")
+
+
+def list_collections(monolith_path, jobs):
+    """Return set of org/repo in monolith, the same as glob('*/*') but in parallel
+
+    Those starting with . or _ are excluded.
+    """
+    orgs = [e.path for e in os.scandir(monolith_path)
+            if not e.name.startswith(('.', '_')) and e.is_dir()]
+
+    def list_org(path):
+        org = op.basename(path)
+        return [f"{org}/{e.name}" for e in os.scandir(path) if not e.name.startswith('.')]
+
+    with ThreadPoolExecutor(jobs) as executor:
+        return set(itertools.chain.from_iterable(executor.map(list_org, orgs)))
+
+
+def iter_image_recs(dbrecs):
+    """Given records of main.container.json, yield those with an image
+
+    as (fields, rec, target_file, mon_relpath) -- without touching monolith yet.
+    """
+    for dbrec in dbrecs:
+        fields = dbrec['fields']
+        # if 'hello' in fields['image']:
+        #     import pdb; pdb.set_trace()
+        if not fields['image']:
+            # just for paranoids
+            assert not get_sif_files(fields)
+            # has no image - skip
+            continue
+        rec = {
+            "id": dbrec["pk"],
+            "branch": fields["branch"],
+            "tag": fields["tag"],
+            "commit": fields["commit"],
+            "version": fields["version"],
+            "build_date": fields["build_date"],
+            # this is apparently not a size of the image!
+            # API does report it as well. correct 'size': '62652447',
+            # is in 'files' record
+            "size_mb": fields['metrics'].get('size_mb'),
+        }
+        # it seems we can match based on image and mediaLink
+        target_file = None
+        for f in fields['files']:
+            if f['mediaLink'] == fields['image']:
+                target_file = f
+                break
+        sif_files = get_sif_files(fields)
+        # if len(sif_files) != 1:
+        #     import pdb; pdb.set_trace()
+        # assert len(sif_files) == 1
+        target_file = None
+        if target_file:
+            assert len(sif_files) == 1
+            assert sif_files[0] == target_file
+        elif sif_files:
+            assert len(sif_files) == 1
+            # Happens for all the "http://datasets.datalad.org/"
+            # redirects already + a few in https://storage.googleapis.com/
+            # Let's fish out among files
+            target_file = sif_files[0]
+
+        # Parse monolith's annex key for extra check for paranoids
+        # + to handle the cases where we do not have proper record
+        # but do have a url
+        img_url = fields['image']
+        if 'datasets.datalad.org' in img_url:
+            assert target_file
+            img_url = target_file['mediaLink']
+        mon_relpath = get_path_from_url(img_url)
+        yield fields, rec, target_file, mon_relpath
+
+
+def iter_container_recs(dbrecs, monolith_path, jobs=1, links_cache=None):
+    """Given records of main.container.json, yield (name, rec) for those with an image"""
+    links = iter_links(iter_image_recs(dbrecs), monolith_path, jobs, links_cache)
+    for (fields, rec, target_file, mon_relpath), link in links:
+        if link is None:
+            raise RuntimeError(f"Found no symlink under {monolith_path / mon_relpath}")
+        annex_key_parsed = from_annex_key(op.basename(link))
+
+        if target_file:
+            target_file['md5'] = base64.b16encode(
+                base64.b64decode(target_file['md5Hash'])).lower().decode()
+            assert target_file['md5'] == annex_key_parsed['md5']
+            assert target_file['size'] == annex_key_parsed['size']
+            # strip away leading prefix including github.com
+            pref = '/github.com/'
+            # just use the one we deduced in monolith -- will be fixed
+            # for singularityhub-legacy
+            target_file['name'] = mon_relpath  # target_file['name'][target_file['name'].index(pref) + len(pref):]
+        else:
+            # it still might be there and may be just a bug in DB?
+            # TODO: check e.g. for BarquistLab/proQ_conventionalMouse_dataAnalysis
+            # tag def
+            #print(f"Found no target image file for {fields['name']}:{fields['tag']} . "
+            #      f"Image url was {fields['image']} but found no matching file record")
+            # So we will deduce it from the image URL
+            target_file = {
+                'name': mon_relpath,
+                'size': int(annex_key_parsed['size']),
+                'md5': annex_key_parsed['md5']
+            }
+        # TODO: just store relevant   image?
+        rec['file'] = target_file['name']
+        rec['collection'] = fields['collection']
+        assert rec['file'].count('/') == 4
+        rec['size'] = int(target_file['size'])
+        rec['md5'] = target_file['md5']
+        yield fields['name'], rec
+
+
 @click.group()
 def main():
     pass
 
 
-@main.command()
-@click.argument("dump_path", type=click.Path(exists=True, file_okay=False))
-@click.argument("monolith_path", type=click.Path(exists=True, file_okay=False))
-@click.argument("output_json", type=click.Path(exists=False, file_okay=True))
-# TODO: option to point to filestore so we could check
-def dump_data(dump_path, monolith_path, output_json):
+def fingerprinted(path, fingerprints):
+    """Yield records of the dump, recording pk: [fingerprint, index in the dump] of each
+
+    Fingerprint is of the text of the record, which is cheaper than of
+    the record reencoded, and Django dumps the same record the same way.
+    """
+    for i, (dbrec, text) in enumerate(iter_dump(path, with_text=True)):
+        fp = hashlib.md5(text.encode()).hexdigest()
+        fingerprints[str(dbrec['pk'])] = [fp, i]
+        yield dbrec
+
+
+def diff_fingerprints(old, new):
+    """Return (added, changed, removed) pks"""
+    added = sorted(set(new) - set(old), key=lambda pk: new[pk][1])
+    changed = sorted((pk for pk in set(new) & set(old) if new[pk][0] != old[pk][0]),
+                     key=lambda pk: new[pk][1])
+    removed = sorted(set(old) - set(new), key=lambda pk: old[pk][1])
+    return added, changed, removed
+
+
+def get_collection_rec(r):
+    repo = ((r.get('fields') or {}).get("repo") or {})
+    # Don't do check here -- some collections might not correspond since
+    # might have been renamed etc. So we will just store all
+    return {
+        'license': repo.get('license'),
+        'full_name': repo.get('full_name'),
+    }
+
+
+def write_json(data, path, indent=2):
+    """Write JSON into a temporary file and rename it over path
+
+    so that a running service never reads a half-written file.
+    """
+    tmp = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(data, indent=indent))
+        os.replace(tmp, path)
+    except BaseException:
+        if op.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def build_data(dump_path, monolith_path, jobs, cache, fingerprints):
+    """Process the whole dump into data for images.json"""
     recs = defaultdict(list)
-    monolith_path = Path(monolith_path)
-    with (Path(dump_path) / "main.container.json").open() as f:
-        orig_recs = json.load(f)
-        for dbrec in tqdm.tqdm(orig_recs):
-            fields = dbrec['fields']
-            # if 'hello' in fields['image']:
-            #     import pdb; pdb.set_trace()
-            if not fields['image']:
-                # just for paranoids
-                assert not get_sif_files(fields)
-                # has no image - skip
-                continue
-            rec = {
-                "id": dbrec["pk"],
-                "branch": fields["branch"],
-                "tag": fields["tag"],
-                "commit": fields["commit"],
-                "version": fields["version"],
-                "build_date": fields["build_date"],
-                # this is apparently not a size of the image!
-                # API does report it as well. correct 'size': '62652447',
-                # is in 'files' record
-                "size_mb": fields['metrics'].get('size_mb'),
-            }
-            # it seems we can match based on image and mediaLink
-            target_file = None
-            for f in fields['files']:
-                if f['mediaLink'] == fields['image']:
-                    target_file = f
-                    break
-            sif_files = get_sif_files(fields)
-            # if len(sif_files) != 1:
-            #     import pdb; pdb.set_trace()
-            # assert len(sif_files) == 1
-            target_file = None
-            if target_file:
-                assert len(sif_files) == 1
-                assert sif_files[0] == target_file
-            elif sif_files:
-                assert len(sif_files) == 1
-                # Happens for all the "http://datasets.datalad.org/"
-                # redirects already + a few in https://storage.googleapis.com/
-                # Let's fish out among files
-                target_file = sif_files[0]
-
-            # Parse monolith's annex key for extra check for paranoids
-            # + to handle the cases where we do not have proper record
-            # but do have a url
-            img_url = fields['image']
-            if 'datasets.datalad.org' in img_url:
-                assert target_file
-                img_url = target_file['mediaLink']
-            mon_relpath = get_path_from_url(img_url)
-            mon_path = (monolith_path / mon_relpath)
-            if not mon_path.is_symlink():
-                raise RuntimeError(f"Found no symlink under {mon_path}")
-            annex_key_parsed = from_annex_key(mon_path.readlink().name)
-
-            if target_file:
-                target_file['md5'] = base64.b16encode(
-                    base64.b64decode(target_file['md5Hash'])).lower().decode()
-                assert target_file['md5'] == annex_key_parsed['md5']
-                assert target_file['size'] == annex_key_parsed['size']
-                # strip away leading prefix including github.com
-                pref = '/github.com/'
-                # just use the one we deduced in monolith -- will be fixed
-                # for singularityhub-legacy
-                target_file['name'] = mon_relpath  # target_file['name'][target_file['name'].index(pref) + len(pref):]
-            else:
-                # it still might be there and may be just a bug in DB?
-                # TODO: check e.g. for BarquistLab/proQ_conventionalMouse_dataAnalysis
-                # tag def
-                #print(f"Found no target image file for {fields['name']}:{fields['tag']} . "
-                #      f"Image url was {fields['image']} but found no matching file record")
-                # So we will deduce it from the image URL
-                target_file = {
-                    'name': mon_relpath,
-                    'size': int(annex_key_parsed['size']),
-                    'md5': annex_key_parsed['md5']
-                }
-            # TODO: just store relevant   image?
-            rec['file'] = target_file['name']
-            rec['collection'] = fields['collection']
-            assert rec['file'].count('/') == 4
-            rec['size'] = int(target_file['size'])
-            rec['md5'] = target_file['md5']
-            recs[fields['name']].append(rec)
+    dbrecs = fingerprinted(dump_path / "main.container.json", fingerprints['containers'])
+    for name, rec in tqdm.tqdm(
+            iter_container_recs(dbrecs, monolith_path, jobs, cache), unit="image"):
+        recs[name].append(rec)
 
     # TODO: traverse monolith and ensure that we do no have some images which
     # are not in our output record
     # Part1 : report (no act) on entire collections
     # Part2 : filtering and reshaping paths I think I will do in a separate command
-    all_under_monolith = (str(p.relative_to(monolith_path)) for p in monolith_path.glob('*/*'))
-    all_under_monolith = set(x for x in all_under_monolith if not (x.startswith('.') or x.startswith('_')))
+    all_under_monolith = list_collections(monolith_path, jobs)
 
     # should be given since we did test all the images above
     assert not set(recs).difference(all_under_monolith)
@@ -190,40 +422,182 @@ def dump_data(dump_path, monolith_path, output_json):
             f"(having no image in main.container.json): {loose_collections}")
 
     collections = {}
-    missing_dir = {}
-    with (Path(dump_path) / "main.collection.json").open() as f:
-        orig_recs = json.load(f)
-        for r in orig_recs:
-            repo = ((r.get('fields') or {}).get("repo") or {})
-            full_name = repo.get('full_name')
-            rec = {
-                'license': repo.get('license'),
-                'full_name': full_name,
-            }
-            # Don't do check here -- some collections might not correspond since
-            # might have been renamed etc. So we will just store all
-            # if not (monolith_path / full_name).is_dir():
-            #     # print(f"WARNING: no monolith dir for {r['pk']}: {full_name}")
-            #     missing_dir[int(r['pk'])] = rec
-            # else:
-            collections[int(r['pk'])] = rec
+    for r in fingerprinted(dump_path / "main.collection.json", fingerprints['collections']):
+        collections[int(r['pk'])] = get_collection_rec(r)
     print(f"INFO: collected {len(collections)} collections")
-    if missing_dir:
-        print(
-            f"WARNING: following {len(missing_dir)} collections had nothing in monolith, and thus skipped:"
-            f" {(', '.join(map(str, missing_dir)))}"
-        )
 
     for collection, containers in recs.items():
         for container in containers:
             container.update(get_shorter_file_rec(container))
 
-    data = {
+    return {
         "images": recs,
         "collections": collections,
     }
-    with open(output_json, 'w') as f:
-        json.dump(data, f, indent=2)
+
+
+def patch_data(data, dump_path, monolith_path, jobs, cache, old, fingerprints):
+    """Reprocess only records of the dump which changed since old fingerprints
+
+    data (of the previous images.json) is patched in place.  Returns list
+    of changes for the change log.
+    """
+    changes = []
+    # containers
+    old_fps, fps = old['containers'], fingerprints['containers']
+    todo = [
+        dbrec for dbrec in fingerprinted(dump_path / "main.container.json", fps)
+        if old_fps.get(str(dbrec['pk']), [None])[0] != fps[str(dbrec['pk'])][0]
+    ]
+    added, changed, removed = diff_fingerprints(old['containers'], fingerprints['containers'])
+    names = {str(rec['id']): name for name, recs in data['images'].items() for rec in recs}
+    for pk in changed + removed:
+        name = names.get(pk)
+        if name:
+            data['images'][name] = [r for r in data['images'][name] if str(r['id']) != pk]
+            if not data['images'][name]:
+                del data['images'][name]
+    new_names = {}
+    for name, rec in tqdm.tqdm(
+            iter_container_recs(todo, monolith_path, jobs, cache), unit="image"):
+        rec.update(get_shorter_file_rec(rec))
+        data['images'].setdefault(name, []).append(rec)
+        new_names[str(rec['id'])] = name
+    for change, pks in (('added', added), ('changed', changed), ('removed', removed)):
+        for pk in pks:
+            # those without an image are not in images.json
+            name = names.get(pk) if change == 'removed' else new_names.get(pk)
+            changes.append({'kind': 'container', 'change': change, 'pk': int(pk), 'name': name})
+    # keep the order of the dump, as if it was all processed anew
+    order = fingerprints['containers']
+    for recs in data['images'].values():
+        recs.sort(key=lambda r: order[str(r['id'])][1])
+    data['images'] = dict(sorted(data['images'].items(),
+                                 key=lambda item: order[str(item[1][0]['id'])][1]))
+
+    # collections: unchanged ones are kept as they are, since they might
+    # have been adjusted by rename_remove
+    new_collections = {
+        str(r['pk']): get_collection_rec(r)
+        for r in fingerprinted(dump_path / "main.collection.json", fingerprints['collections'])
+    }
+    added, changed, removed = diff_fingerprints(old['collections'], fingerprints['collections'])
+    collections = {str(pk): rec for pk, rec in data['collections'].items()}
+    for pk in added + changed:
+        collections[pk] = new_collections[pk]
+    for pk in removed:
+        collections.pop(pk, None)
+    for change, pks in (('added', added), ('changed', changed), ('removed', removed)):
+        for pk in pks:
+            rec = collections.get(pk) or data['collections'].get(pk) or {}
+            changes.append({'kind': 'collection', 'change': change, 'pk': int(pk),
+                            'name': rec.get('full_name')})
+    order = fingerprints['collections']
+    data['collections'] = dict(sorted(collections.items(), key=lambda item: order[item[0]][1]))
+    return changes
+
+
+@main.command()
+@click.argument("dump_path", type=click.Path(exists=True, file_okay=False))
+@click.argument("monolith_path", type=click.Path(exists=True, file_okay=False))
+@click.argument("output_json", type=click.Path(exists=False, file_okay=True))
+@click.option("-j", "--jobs", type=int, default=16, show_default=True,
+              help="Number of threads to check monolith with. Helps a lot on network "
+                   "filesystems")
+@click.option("--links-cache", type=click.Path(dir_okay=False),
+              help="File to keep symlinks read from monolith in, for reruns to read "
+                   "only new ones while monolith is at the same git HEAD")
+@click.option("--state", "state_path", type=click.Path(dir_okay=False),
+              help="File with fingerprints of dump records OUTPUT_JSON was produced "
+                   "from. If it and OUTPUT_JSON exist, only added, changed and removed "
+                   "records are reprocessed and OUTPUT_JSON is patched")
+@click.option("--changelog", type=click.Path(dir_okay=False),
+              help="File to append JSON lines with changes to, when patching "
+                   "[default: OUTPUT_JSON.changes.jsonl]")
+# TODO: option to point to filestore so we could check
+def dump_data(dump_path, monolith_path, output_json, jobs, links_cache, state_path, changelog):
+    monolith_path = Path(monolith_path)
+    dump_path = Path(dump_path)
+    cache = None
+    if links_cache:
+        version = get_monolith_version(monolith_path)
+        if version:
+            cache = LinksCache(links_cache, version)
+        else:
+            print(f"WARNING: {monolith_path} is not a git repository, so could not tell "
+                  f"if {links_cache} is up to date. Not using it")
+    fingerprints = {'containers': {}, 'collections': {}}
+    t0 = time.time()
+    try:
+        if state_path and op.exists(state_path) and op.exists(output_json):
+            with open(state_path) as f:
+                old = json.load(f)
+            with open(output_json) as f:
+                data = json.load(f)
+            changes = patch_data(data, dump_path, monolith_path, jobs, cache, old,
+                                 fingerprints)
+        else:
+            data = build_data(dump_path, monolith_path, jobs, cache, fingerprints)
+            changes = None
+    finally:
+        if cache is not None:
+            cache.close()
+
+    if changes != []:
+        write_json(data, output_json)
+    if state_path:
+        # no indent: C encoder is used then, and nobody reads it anyways
+        write_json(fingerprints, state_path, indent=None)
+    if changes is not None:
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+        with open(changelog or f"{output_json}.changes.jsonl", 'a') as f:
+            for change in changes:
+                f.write(json.dumps({'time': stamp, **change}) + "\n")
+        counts = Counter(f"{c['change']} {c['kind']}s" for c in changes)
+        print(f"INFO: patched {output_json} in {time.time() - t0:.1f} sec: "
+              f"{', '.join(f'{n} {what}' for what, n in sorted(counts.items())) or 'no changes'}")
+
+
+@main.command()
+@click.option("-n", "--number", type=int, default=20000, show_default=True,
+              help="Number of symlinks in the synthetic tree")
+@click.option("-j", "--jobs", default="1,4,16,64", show_default=True,
+              help="Comma separated numbers of threads to try")
+@click.option("--latency", type=float, default=0, show_default=True,
+              help="Milliseconds to add to every readlink, as on a network filesystem")
+@click.option("--tmpdir", type=click.Path(file_okay=False),
+              help="Where to create the tree. Should be on the filesystem of interest")
+def bench_links(number, jobs, latency, tmpdir):
+    """Benchmark reading of monolith symlinks on a synthetic tree"""
+    import random
+    import tempfile
+    with tempfile.TemporaryDirectory(dir=tmpdir) as top:
+        top = Path(top)
+        relpaths = []
+        for i in range(number):
+            md5 = "%032x" % random.getrandbits(128)
+            relpath = f"org{i % 300}/repo{i}/{'%040x' % random.getrandbits(160)}/{md5}/{md5}.sif"
+            (top / relpath).parent.mkdir(parents=True)
+            key = f"MD5E-s{random.randint(1, 1 << 32)}--{md5}.sif"
+            os.symlink(f"../../../../.git/annex/objects/{key}/{key}", top / relpath)
+            relpaths.append((relpath,))
+
+        def slow_read_link(path):
+            time.sleep(latency / 1000)
+            return read_link(path)
+
+        for j in map(int, jobs.split(',')):
+            t0 = time.time()
+            n = sum(1 for _ in iter_links(relpaths, top, j, readlink=slow_read_link))
+            print(f"{j:4d} threads: {n / (time.time() - t0):8.0f} links/sec")
+        cache = LinksCache(str(top / 'links.tsv'), 'bench')
+        list(iter_links(relpaths, top, j, cache, readlink=slow_read_link))
+        cache.close()
+        cache = LinksCache(str(top / 'links.tsv'), 'bench')
+        t0 = time.time()
+        n = sum(1 for _ in iter_links(relpaths, top, j, cache, readlink=slow_read_link))
+        print(f"      cached: {n / (time.time() - t0):8.0f} links/sec")
+        cache.close()
 
 
 def get_shorter_file_rec(r):
@@ -249,22 +623,142 @@ def get_shorter_file_rec(r):
     return r_
 
 
+SQLITE_SCHEMA = """
+PRAGMA journal_mode = WAL;
+CREATE TABLE collections (
+    pk INTEGER PRIMARY KEY,
+    full_name TEXT,
+    license_id TEXT,    -- spdx_id (or name) of the license
+    rec TEXT NOT NULL   -- JSON record as in images.json
+);
+-- rowid keeps the order of images.json, which matters for records of the
+-- same build date
+CREATE TABLE images (
+    name TEXT NOT NULL,
+    id INTEGER,
+    tag TEXT,
+    version TEXT,
+    "commit" TEXT,
+    build_date TEXT,
+    collection INTEGER,
+    size INTEGER,
+    md5 TEXT,
+    file TEXT,
+    rec TEXT NOT NULL   -- JSON record as in images.json
+);
+CREATE INDEX images_name ON images (name);
+CREATE INDEX images_md5 ON images (md5);
+CREATE INDEX images_collection ON images (collection);
+CREATE INDEX images_build_date ON images (build_date);
+CREATE INDEX images_size ON images (size);
+CREATE INDEX collections_full_name ON collections (full_name);
+CREATE INDEX collections_license_id ON collections (license_id);
+"""
+
+
 @main.command()
-@click.argument("monolith_path", type=click.Path(exists=True, file_okay=False))
 @click.argument("images_json", type=click.Path(exists=True, file_okay=True))
-# TODO: option to point to filestore so we could check
-def rename_remove(monolith_path, images_json):
-    """Take new "file" paths and rename, and also remove those which are not known"""
-    from datalad.support.annexrepo import AnnexRepo
-    repo = AnnexRepo(monolith_path)
-    monolith_path = Path(monolith_path)
+@click.argument("output_db", type=click.Path(exists=False, file_okay=True))
+def sqlite(images_json, output_db):
+    """Convert images.json into an indexed SQLite database
+
+    serve.py could serve it directly, and it could be queried (see `query`)
+    without loading it all.
+    """
+    import sqlite3
+    import sys
+    # license_id as the /search endpoint of the service takes it
+    sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))), "_service_"))
+    from search import get_license
+    t0 = time.time()
     with open(images_json) as f:
         data = json.load(f)
+    tmp = f"{output_db}.tmp"
+    for p in (tmp, tmp + '-wal', tmp + '-shm'):
+        if op.exists(p):
+            os.unlink(p)
+    db = sqlite3.connect(tmp)
+    db.executescript(SQLITE_SCHEMA)
+    with db:
+        db.executemany(
+            "INSERT INTO collections VALUES (?, ?, ?, ?)",
+            ((int(pk), c.get('full_name'), get_license(c.get('license')), json.dumps(c))
+             for pk, c in data['collections'].items()))
+        db.executemany(
+            "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((name, r.get('id'), r.get('tag'), r.get('version'), r.get('commit'),
+              r.get('build_date'), r.get('collection'), r.get('size'), r.get('md5'),
+              r.get('file'), json.dumps(r))
+             for name, recs in data['images'].items() for r in recs))
+    db.execute("ANALYZE")
+    # fold WAL back, so the single file is complete, and switch out of WAL
+    # so that readers need no -wal/-shm next to it (nor a writable directory)
+    db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.execute("PRAGMA journal_mode = DELETE")
+    db.close()
+    # those of the previous DB must not get paired with the new one
+    for p in (output_db + '-wal', output_db + '-shm'):
+        if op.exists(p):
+            os.unlink(p)
+    os.replace(tmp, output_db)
+    print(f"INFO: wrote {sum(map(len, data['images'].values()))} images of "
+          f"{len(data['images'])} containers and {len(data['collections'])} "
+          f"collections into {output_db} in {time.time() - t0:.1f} sec")
 
-    # Tired yoh cannot get it why we ending up with string keys in json - not supported?
-    for pk in list(data['collections']):
-        data['collections'][int(pk)] = data['collections'].pop(pk)
 
+@main.command()
+@click.argument("db_path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--name", help="Container (org/repo), could have % wildcards")
+@click.option("--collection", type=int, help="pk of the collection")
+@click.option("--license", "license_id", help="License id, e.g. MIT")
+@click.option("--built-after", help="Build date (ISO) not before")
+@click.option("--built-before", help="Build date (ISO) before")
+@click.option("--min-size", type=int, help="Bytes")
+@click.option("--max-size", type=int, help="Bytes")
+@click.option("--limit", type=int, default=0, help="0 for no limit")
+def query(db_path, name, collection, license_id, built_after, built_before,
+          min_size, max_size, limit):
+    """Print images (JSON lines, as in images.json plus name) matching all criteria"""
+    import sqlite3
+    db = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    where, args = [], []
+    for cond, value in (
+            ("images.name LIKE ?", name),
+            ("images.collection = ?", collection),
+            ("collections.license_id = ?", license_id),
+            ("images.build_date >= ?", built_after),
+            ("images.build_date < ?", built_before),
+            ("images.size >= ?", min_size),
+            ("images.size <= ?", max_size)):
+        if value is not None:
+            where.append(cond)
+            args.append(value)
+    sql = "SELECT images.name, images.rec FROM images"
+    if license_id is not None:
+        sql += " JOIN collections ON collections.pk = images.collection"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY images.rowid"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    for name_, rec in db.execute(sql, args):
+        print(json.dumps({'name': name_, **json.loads(rec)}))
+
+
+def git(path, *args, input=None):
+    """Run git within path and return its stdout"""
+    return subprocess.run(
+        ['git', '-C', str(path)] + list(args),
+        input=input, stdout=subprocess.PIPE, check=True).stdout
+
+
+def chunks(items, size=GIT_CHUNK):
+    """Split list into lists of at most size, to not exceed max command line"""
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def plan_rename_remove(monolith_path, data):
+    """Return (to_remove, to_move) directories, adjusting data['collections']"""
     # Remove all collections which are not included
     known_collections = {r['full_name']: int(pk) for pk, r in data['collections'].items()}
     # Add those which might have been renamed but still present under original names
@@ -297,7 +791,6 @@ def rename_remove(monolith_path, images_json):
     dirs_images = set(itertools.chain(
         *([op.dirname(x['file_orig']) for x in recs] for recs in data['images'].values())
     ))
-    # import pdb; pdb.set_trace()
 
     # Let's first remove all those collections which aren't known:
     # Do it first so when we get to rename container dirs, we fail if
@@ -305,24 +798,15 @@ def rename_remove(monolith_path, images_json):
     to_remove = []
     for c in sorted(cols_under_monolith):
         if c not in known_collections:
-            print(f"{c}: removing entirely")
             to_remove.append(c)
-            cols_under_monolith.pop(c)
+            continue
         # remove individual image directories
-        keep = []
-        for d in cols_under_monolith[c]:
-            if d not in dirs_images:
-                print(f"{c}: removing {d}")
-                to_remove.append(d)
-            else:
-                keep.append(d)
-        cols_under_monolith[c] = d
-    if to_remove:
-        print(f"REMOVING {len(to_remove)} directories")
-        repo.call_git(['rm', '-rf'] + to_remove)
-        repo.call_git(['clean', '-dfx'])
+        to_remove.extend(d for d in sorted(cols_under_monolith[c]) if d not in dirs_images)
+    removed = set(to_remove)
 
     # Now we need to rename all what is left
+    to_move = []
+    dests = set()
     for c, containers in sorted(data['images'].items()):
         for con in containers:
             src = op.dirname(con['file_orig'])
@@ -330,18 +814,131 @@ def rename_remove(monolith_path, images_json):
             dest = op.dirname(con['file'])
             # we do it once!
             assert (monolith_path / src).exists()
+            assert op.join(*Path(src).parts[:2]) not in removed
             assert not (monolith_path / dest).exists()
-            pdest = (monolith_path / dest).parent
-            if not pdest.exists():
-                pdest.mkdir(parents=True)
-            print(f"Moving {src} to {dest}")
-            repo.call_git(['mv', src, dest])
+            assert dest not in dests
+            dests.add(dest)
+            to_move.append((src, dest))
+    return to_remove, to_move
+
+
+def apply_rename_remove(monolith_path, to_remove, to_move):
+    """Remove and move directories in a few git calls"""
+    for chunk in chunks(to_remove):
+        git(monolith_path, 'rm', '-rfq', '--', *chunk)
+    if to_remove:
+        git(monolith_path, 'clean', '-dfx')
+
+    # Instead of a `git mv` (a process and rewrite of the index) per
+    # container, move directories ourselves and then tell the index about
+    # all of them at once.  Images stay at the same depth, so relative
+    # annex symlinks stay valid.
+    moves = dict(to_move)
+    index_info = []
+    for chunk in chunks(list(moves)):
+        out = git(monolith_path, 'ls-files', '-s', '-z', '--', *chunk)
+        for entry in out.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.decode().split('\t', 1)
+            mode, sha, _ = info.split()
+            parts = path.split('/')
+            src = '/'.join(parts[:4])
+            dest = op.join(moves[src], *parts[4:])
+            index_info.append(f"0 {'0' * len(sha)}\t{path}\0")
+            index_info.append(f"{mode} {sha}\t{dest}\0")
+    for src, dest in tqdm.tqdm(to_move, unit="dir"):
+        (monolith_path / dest).parent.mkdir(parents=True, exist_ok=True)
+        os.rename(monolith_path / src, monolith_path / dest)
+    git(monolith_path, 'update-index', '-z', '--index-info',
+        input=''.join(index_info).encode())
+    git(monolith_path, 'clean', '-dfx')
 
-    repo.call_git(['clean', '-dfx'])
+
+@main.command()
+@click.argument("monolith_path", type=click.Path(exists=True, file_okay=False))
+@click.argument("images_json", type=click.Path(exists=True, file_okay=True))
+@click.option("-n", "--dry-run", is_flag=True,
+              help="Only print what would be removed and moved")
+# TODO: option to point to filestore so we could check
+def rename_remove(monolith_path, images_json, dry_run):
+    """Take new "file" paths and rename, and also remove those which are not known"""
+    monolith_path = Path(monolith_path)
+    with open(images_json) as f:
+        data = json.load(f)
+
+    # Tired yoh cannot get it why we ending up with string keys in json - not supported?
+    for pk in list(data['collections']):
+        data['collections'][int(pk)] = data['collections'].pop(pk)
+
+    to_remove, to_move = plan_rename_remove(monolith_path, data)
+    for d in to_remove:
+        print(f"remove {d}")
+    for src, dest in to_move:
+        print(f"move {src} {dest}")
+    print(f"INFO: {len(to_remove)} directories to remove, {len(to_move)} to move")
+    if dry_run:
+        return
+
+    t0 = time.time()
+    apply_rename_remove(monolith_path, to_remove, to_move)
+    print(f"INFO: done in {time.time() - t0:.1f} sec")
 
     # we might have adjusted collections
-    with open(images_json, 'w') as f:
-        json.dump(data, f, indent=2)
+    write_json(data, images_json)
+
+
+@main.command()
+@click.option("-n", "--number", default="100,1000,5000", show_default=True,
+              help="Comma separated numbers of containers to try")
+@click.option("--git-mv", is_flag=True,
+              help="Also time a `git mv` per container, as it was done before")
+@click.option("--tmpdir", type=click.Path(file_okay=False))
+def bench_rename(number, git_mv, tmpdir):
+    """Benchmark rename_remove on synthetic repositories"""
+    import random
+    import tempfile
+    for n in map(int, number.split(',')):
+        with tempfile.TemporaryDirectory(dir=tmpdir) as top:
+            top = Path(top)
+            git(top, 'init', '-q')
+            data = {'images': defaultdict(list), 'collections': {}}
+            for i in range(n + n // 10):
+                org, repo = f"org{i % 100}", f"repo{i // 2}"
+                commit, md5 = '%040x' % random.getrandbits(160), '%032x' % random.getrandbits(128)
+                file_orig = f"{org}/{repo}/{commit}/{md5}/{md5}.sif"
+                (top / file_orig).parent.mkdir(parents=True)
+                key = f"MD5E-s{i}--{md5}.sif"
+                os.symlink(f"../../../../.git/annex/objects/{key}/{key}", top / file_orig)
+                if i >= n:
+                    # extra ones to remove
+                    continue
+                data['collections'][i // 2] = {'full_name': f"{org}/{repo}"}
+                rec = {'tag': f"v{i}", 'build_date': '2020-01-01T00:00:00', 'commit': commit,
+                       'collection': i // 2, 'file': file_orig}
+                data['images'][f"{org}/{repo}"].append(get_shorter_file_rec(rec))
+            git(top, 'add', '.')
+            git(top, '-c', 'user.name=bench', '-c', 'user.email=bench@example.com',
+                'commit', '-qm', 'synthetic')
+            t0 = time.time()
+            to_remove, to_move = plan_rename_remove(top, data)
+            t_plan = time.time() - t0
+            msg = ""
+            if git_mv:
+                t0 = time.time()
+                for src, dest in to_move:
+                    (top / dest).parent.mkdir(parents=True, exist_ok=True)
+                    git(top, 'mv', src, dest)
+                msg = f" (git mv per container: {time.time() - t0:.2f} sec)"
+                git(top, 'reset', '-q', '--hard')
+                git(top, 'clean', '-qdfx')
+            t0 = time.time()
+            apply_rename_remove(top, to_remove, to_move)
+            t_apply = time.time() - t0
+            status = git(top, 'diff', '--cached', '-M', '--name-status').decode().splitlines()
+            renames = sum(line.startswith('R100') for line in status)
+            print(f"{n:6d} containers: plan {t_plan:.2f} sec, apply {t_apply:.2f} sec{msg}, "
+                  f"{renames} renames and {len(status) - renames} other changes in the index")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Report where the space of the archive goes and how much of it is duplicated
+
+A single os.scandir pass over */*/*/* of the dataset collects every image
+with md5 and size from its annex key (no content is read, so absent content
+does not matter), and also finds directories which cleanup.sh used to remove:
+empty ones and those without an image.  Combined with images.json (for
+build dates and images which are not annexed) it reports
+
+- duplicate groups: the same md5 at several locations,
+- bytes reclaimable: locations beyond the first one of each md5 (what a
+  plain copy of the tree takes extra), and annex objects beyond the first
+  one of each md5 (what the annex actually stores extra, since keys of
+  the same content differ only by extension),
+- size histograms per org and per build year,
+- inconsistencies between the tree and the catalog,
+
+as JSON, e.g.
+
+    _tools_/storage_report.py --catalog _data_/images.json . > report.json
+
+With --remove it also does what cleanup.sh did: git rm's directories
+without an image, and removes empty ones.
+"""
+
+import json
+import os
+import os.path as op
+import re
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+import click
+
+ANNEX_KEY_REGEX = re.compile(r'^MD5E?-s(?P<size>\d+)--(?P<md5>[0-9a-f]{32})')
+# as cleanup.sh looked for them
+IMAGE_REGEX = re.compile(r'\.si[mf]|\.img\.gz$')
+# max number of paths to pass to a single git call
+GIT_CHUNK = 1000
+
+
+def scan(top):
+    """Single pass over */*/*/* of top
+
+    Returns
+    -------
+    images: dict
+      relpath: (md5 or None, size, annex key or None)
+    empty: list
+      directories with nothing in them
+    no_image: dict
+      directory: [names of what is in it]
+    """
+    images, empty, no_image = {}, [], {}
+
+    def subdirs(path, skip=('.',)):
+        return sorted((e.name, e.path) for e in os.scandir(path)
+                      if not e.name.startswith(skip) and e.is_dir())
+
+    for org, org_path in subdirs(top, ('.', '_')):
+        for repo, repo_path in subdirs(org_path):
+            for d1, d1_path in subdirs(repo_path):
+                for d2, d2_path in subdirs(d1_path):
+                    d = f"{org}/{repo}/{d1}/{d2}"
+                    entries = list(os.scandir(d2_path))
+                    if not entries:
+                        empty.append(d)
+                        continue
+                    found = False
+                    for e in entries:
+                        if not IMAGE_REGEX.search(e.name):
+                            continue
+                        found = True
+                        relpath = f"{d}/{e.name}"
+                        if e.is_symlink():
+                            key = op.basename(os.readlink(e.path))
+                            res = ANNEX_KEY_REGEX.match(key)
+                            if res:
+                                images[relpath] = (res.group('md5'), int(res.group('size')), key)
+                                continue
+                        # not annexed, or unlocked: size is all we could know
+                        # without reading it
+                        try:
+                            size = e.stat().st_size
+                        except FileNotFoundError:
+                            size = None
+                        images[relpath] = (None, size, None)
+                    if not found:
+                        no_image[d] = sorted(e.name for e in entries)
+    return images, empty, no_image
+
+
+def load_catalog(path):
+    """Return {file: (md5, size, build_date)} from images.json"""
+    with open(path) as f:
+        data = json.load(f)
+    return {
+        r['file']: (r['md5'], r['size'], r.get('build_date'))
+        for recs in data['images'].values() for r in recs
+    }
+
+
+def build_report(images, empty, no_image, catalog, top_n):
+    records = {}          # relpath: (md5, size, year, annex key)
+    inconsistent = []
+    for relpath, (md5, size, key) in images.items():
+        cat = catalog.get(relpath)
+        if cat:
+            if md5 and md5 != cat[0] or size is not None and size != cat[1]:
+                inconsistent.append({'path': relpath, 'problem': 'catalog_differs',
+                                     'tree': [md5, size], 'catalog': list(cat[:2])})
+            md5 = md5 or cat[0]
+            size = size if size is not None else cat[1]
+        elif catalog:
+            inconsistent.append({'path': relpath, 'problem': 'not_in_catalog'})
+        year = cat[2][:4] if cat and cat[2] else 'unknown'
+        records[relpath] = (md5, size or 0, year, key)
+    for relpath in sorted(set(catalog) - set(images)):
+        inconsistent.append({'path': relpath, 'problem': 'not_in_tree'})
+
+    by_md5 = defaultdict(list)
+    for relpath, (md5, size, _, key) in sorted(records.items()):
+        if md5:
+            by_md5[md5].append((relpath, size, key))
+    groups = []
+    plain = annexed = 0
+    for md5, locations in by_md5.items():
+        if len(locations) < 2:
+            continue
+        size = locations[0][1]
+        keys = {key for _, _, key in locations if key}
+        extra_plain = size * (len(locations) - 1)
+        extra_annexed = size * max(len(keys) - 1, 0)
+        plain += extra_plain
+        annexed += extra_annexed
+        groups.append({'md5': md5, 'size': size, 'count': len(locations),
+                       'reclaimable': extra_plain, 'annex_keys': sorted(keys),
+                       'locations': [loc for loc, _, _ in locations]})
+    groups.sort(key=lambda g: (-g['reclaimable'], g['md5']))
+
+    def histogram(key):
+        hist = defaultdict(Counter)
+        seen = set()
+        for relpath, (md5, size, year, _) in sorted(records.items()):
+            h = hist[key(relpath, year)]
+            h['images'] += 1
+            h['bytes'] += size
+            # bytes of content not seen in paths sorted before
+            if not md5 or md5 not in seen:
+                h['unique_bytes'] += size
+                seen.add(md5)
+        return {k: dict(v) for k, v in sorted(hist.items())}
+
+    total = sum(size for _, size, _, _ in records.values())
+    return {
+        'summary': {
+            'images': len(records),
+            'bytes': total,
+            'unique_md5': len(by_md5),
+            'without_md5': sum(1 for r in records.values() if not r[0]),
+            'duplicate_groups': len(groups),
+            'reclaimable_bytes': plain,
+            'reclaimable_annex_bytes': annexed,
+            'empty_dirs': len(empty),
+            'no_image_dirs': len(no_image),
+            'inconsistencies': len(inconsistent),
+        },
+        'duplicate_groups': groups[:top_n] if top_n else groups,
+        'per_org': histogram(lambda relpath, year: relpath.split('/', 1)[0]),
+        'per_year': histogram(lambda relpath, year: year),
+        'empty_dirs': empty,
+        'no_image_dirs': no_image,
+        'inconsistencies': inconsistent,
+    }
+
+
+def remove_dirs(top, empty, no_image):
+    """What cleanup.sh did, but with a few git calls"""
+    dirs = sorted(no_image)
+    for i in range(0, len(dirs), GIT_CHUNK):
+        # could have no files known to git, as cleanup.sh we do not mind
+        subprocess.run(['git', '-C', top, 'rm', '-rfq', '--ignore-unmatch', '--']
+                       + dirs[i:i + GIT_CHUNK], check=True)
+    for d in empty + dirs:
+        # and then parents which became empty, up to the org
+        while d and op.isdir(op.join(top, d)):
+            try:
+                os.rmdir(op.join(top, d))
+            except OSError:
+                break
+            d = op.dirname(d)
+
+
+@click.command()
+@click.argument("top", type=click.Path(exists=True, file_okay=False), default=".")
+@click.option("--catalog", type=click.Path(exists=True, dir_okay=False),
+              help="images.json for build dates and to check against")
+@click.option("--top-groups", type=int, default=100, show_default=True,
+              help="Number of biggest duplicate groups to list. 0 for all")
+@click.option("-o", "--output", type=click.File("w"), default="-",
+              help="Where to write JSON report to")
+@click.option("--remove", is_flag=True,
+              help="Remove directories without an image (git rm) and empty ones")
+def main(top, catalog, top_groups, output, remove):
+    """Report duplicates and usage of space in the dataset under TOP"""
+    t0 = time.time()
+    images, empty, no_image = scan(top)
+    t1 = time.time()
+    report = build_report(images, empty, no_image,
+                          load_catalog(catalog) if catalog else {}, top_groups)
+    json.dump(report, output, indent=1)
+    output.write("\n")
+    s = report['summary']
+    print(f"INFO: scanned {len(images)} images in {t1 - t0:.1f} sec, "
+          f"{s['bytes'] / 2**30:.1f} GB in total. {s['duplicate_groups']} "
+          f"duplicate groups, {s['reclaimable_bytes'] / 2**30:.1f} GB reclaimable "
+          f"({s['reclaimable_annex_bytes'] / 2**30:.1f} GB in annex). "
+          f"{len(empty)} empty dirs, {len(no_image)} without an image, "
+          f"{s['inconsistencies']} inconsistencies with the catalog",
+          file=sys.stderr)
+    if remove:
+        remove_dirs(top, empty, no_image)
+
+
+if __name__ == '__main__':
+    main()
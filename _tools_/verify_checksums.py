@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Verify checksums of all images in the dataset
+
+For every image in */*/*/* directories (as verify_md5.sh did) md5 and sha256
+are computed in a single pass over the file, on a pool of processes, and
+checked against
+
+- the annex key (MD5E-s<size>--<md5>) the image symlink points to,
+- the checksum in the name of the directory of the image (md5, or sha256
+  if it is longer), or its first 8 characters if directories were already
+  renamed by process_dump.py rename_remove.
+
+Results are recorded in a state DB (sqlite) as they come, so an interrupted
+run resumes where it stopped, and later runs do not rehash files whose size
+and mtime did not change since (unless --rehash).  Every problem (mismatch,
+or just absent annexed content) known after the run is written as a JSON
+line into the report, e.g.
+
+    _tools_/verify_checksums.py -j 8 --state ~/.cache/shub-checksums.db \\
+        --report /tmp/shub-mismatches.jsonl /srv/datasets.datalad.org/shub
+
+Exits with 1 if there were mismatches.
+"""
+
+import hashlib
+import json
+import os
+import os.path as op
+import re
+import sys
+import time
+
+import click
+import tqdm
+
+from hashpool import StateDB, default_state_path, hash_all
+
+ANNEX_KEY_REGEX = re.compile(r'^MD5E-s(?P<size>\d+)--(?P<md5>[0-9a-f]{32})')
+IMAGE_REGEX = re.compile(r'\.si[mf]')
+# directory of an image is named either after its checksum (as originally),
+# or <build date>-<commit[:8]>-<checksum[:8]> (after rename_remove)
+DIR_REGEX = re.compile(
+    r'^(?:(?P<checksum>[0-9a-f]{32}|[0-9a-f]{64})'
+    r'|\d{4}-\d\d-\d\d-[0-9a-f]{1,8}-(?P<prefix>[0-9a-f]{8}))$')
+# bytes to read at once
+BUFFER_SIZE = 1 << 24
+# reported, but nothing wrong with what we have
+NOT_FAILURES = ('absent', 'no_image')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    md5 TEXT,
+    sha256 TEXT,
+    problems TEXT,  -- JSON list, empty if all good
+    checked REAL
+)
+"""
+
+
+def find_images(top):
+    """Yield relative paths of images under */*/*/* of top
+
+    Those starting with . or _ at the top level are not considered, and only
+    the first image in a directory (as verify_md5.sh did).
+    """
+    def subdirs(path, skip=('.',)):
+        try:
+            return sorted(e.name for e in os.scandir(path)
+                          if e.is_dir() and not e.name.startswith(skip))
+        except NotADirectoryError:
+            return []
+
+    for org in subdirs(top, ('.', '_')):
+        for repo in subdirs(op.join(top, org)):
+            for d1 in subdirs(op.join(top, org, repo)):
+                for d2 in subdirs(op.join(top, org, repo, d1)):
+                    d = op.join(org, repo, d1, d2)
+                    images = sorted(f for f in os.listdir(op.join(top, d))
+                                    if IMAGE_REGEX.search(f))
+                    if images:
+                        yield op.join(d, images[0])
+                    else:
+                        yield d + '/'
+
+
+def hash_file(path):
+    """Return (md5, sha256) of the file, computed in a single pass"""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            # both release the GIL, but we are in a process of our own anyways
+            md5.update(view[:n])
+            sha256.update(view[:n])
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def check(top, relpath, st):
+    """Hash the image and return (md5, sha256, problems)"""
+    md5, sha256 = hash_file(op.join(top, relpath))
+    problems = []
+    key = op.basename(op.realpath(op.join(top, relpath)))
+    res = ANNEX_KEY_REGEX.match(key)
+    if not res:
+        problems.append({'problem': 'not_annexed', 'key': key})
+    else:
+        if res.group('md5') != md5:
+            problems.append({'problem': 'annex_md5', 'expected': res.group('md5'),
+                             'computed': md5})
+        if int(res.group('size')) != st.st_size:
+            problems.append({'problem': 'annex_size', 'expected': int(res.group('size')),
+                             'computed': st.st_size})
+    dirname = op.basename(op.dirname(relpath))
+    res = DIR_REGEX.match(dirname)
+    if res and res.group('checksum'):
+        checksum = res.group('checksum')
+        # as in verify_md5.sh: long ones are sha256, the others are md5
+        kind, computed = ('sha256', sha256) if len(checksum) >= 48 else ('md5', md5)
+        if checksum != computed:
+            problems.append({'problem': f'dir_{kind}', 'expected': checksum,
+                             'computed': computed})
+    elif res:
+        # renamed by process_dump.py rename_remove: we do not know any longer
+        # which one it was
+        prefix = res.group('prefix')
+        if prefix not in (md5[:8], sha256[:8]):
+            problems.append({'problem': 'dir_prefix', 'expected': prefix,
+                             'computed': [md5[:8], sha256[:8]]})
+    return md5, sha256, problems
+
+
+class State(StateDB):
+    """DB of results of previous checks"""
+
+    def __init__(self, path):
+        super().__init__(path, SCHEMA)
+
+    def get(self, relpath):
+        """Return (size, mtime_ns, problems) of the last check, or None"""
+        row = self.db.execute(
+            "SELECT size, mtime_ns, problems FROM files WHERE path = ?",
+            (relpath,)).fetchone()
+        return row and (row[0], row[1], json.loads(row[2]))
+
+    def record(self, relpath, st, md5, sha256, problems):
+        self.insert(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (relpath, st.st_size, st.st_mtime_ns, md5, sha256,
+             json.dumps(problems), time.time()))
+
+
+@click.command()
+@click.argument("top", type=click.Path(exists=True, file_okay=False), default=".")
+@click.option("-j", "--jobs", type=int, default=os.cpu_count(), show_default=True,
+              help="Number of processes to hash in")
+@click.option("--state", type=click.Path(dir_okay=False),
+              help="State DB to resume from and to record into. "
+                   "[default: in git dir of TOP, or in ~/.cache/shub]")
+@click.option("--report", type=click.File("w"), default="-", show_default=True,
+              help="Where to write JSON lines with problems")
+@click.option("--rehash", is_flag=True,
+              help="Rehash even those which did not change since the last check")
+def main(top, jobs, state, report, rehash):
+    """Verify md5 and sha256 of images under TOP"""
+    state = State(state or default_state_path(top, 'verify_checksums'))
+    problems = {}  # relpath: [problems]
+    todo = []      # (relpath, stat)
+    n_absent = n_skipped = 0
+    for relpath in tqdm.tqdm(find_images(top), unit="dir", desc="scanning"):
+        if relpath.endswith('/'):
+            problems[relpath] = [{'problem': 'no_image'}]
+            continue
+        try:
+            st = os.stat(op.join(top, relpath))
+        except FileNotFoundError:
+            # annexed content is not here, nothing to check
+            n_absent += 1
+            problems[relpath] = [{'problem': 'absent'}]
+            continue
+        prev = None if rehash else state.get(relpath)
+        if prev and prev[:2] == (st.st_size, st.st_mtime_ns):
+            n_skipped += 1
+            if prev[2]:
+                problems[relpath] = prev[2]
+            continue
+        todo.append((relpath, st))
+
+    total = sum(st.st_size for _, st in todo)
+    print(f"INFO: {len(todo)} images ({total / 2**30:.1f} GB) to hash, "
+          f"{n_skipped} unchanged since the last check, {n_absent} absent",
+          file=sys.stderr)
+    t0 = time.time()
+    for relpath, st, result, exc in hash_all(check, top, todo, jobs, state):
+        if exc:
+            # not recorded, so would be retried next time
+            problems[relpath] = [{'problem': 'error', 'error': str(exc)}]
+            continue
+        md5, sha256, file_problems = result
+        state.record(relpath, st, md5, sha256, file_problems)
+        if file_problems:
+            problems[relpath] = file_problems
+            tqdm.tqdm.write(f"ERROR: {relpath}: {file_problems}", file=sys.stderr)
+    dt = time.time() - t0
+    print(f"INFO: hashed {total / 2**20:.0f} MB in {dt:.1f} sec "
+          f"({total / 2**20 / max(dt, 1e-6):.0f} MB/sec)", file=sys.stderr)
+
+    for relpath, file_problems in sorted(problems.items()):
+        for problem in file_problems:
+            report.write(json.dumps({'path': relpath, **problem}) + "\n")
+    n_bad = sum(any(p['problem'] not in NOT_FAILURES for p in file_problems)
+                for file_problems in problems.values())
+    print(f"INFO: {n_bad} images with problems, {n_absent} absent", file=sys.stderr)
+    if n_bad:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()